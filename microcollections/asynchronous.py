@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+Non blocking twins of the collection API. Calls are dispatched to a shared
+pool of worker threads and return results that can be waited on with
+`.get()`, so many lookups can be in flight from a single caller. The
+wrapped data store is called from several threads at once so it must be
+thread safe.
+'''
+from __future__ import absolute_import
+
+import Queue
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+def wait_all(results, timeout=None):
+    '''
+    Waits on each pending result and returns their values in order
+    '''
+    return [result.get(timeout) for result in results]
+
+
+class AsyncCollectionQuery(object):
+    '''
+    Runs the methods of a CollectionQuery in the worker pool
+    '''
+    #methods returning a new query, these are wrapped instead of submitted
+    builders = ('order_by', 'only', 'defer', 'values', 'values_list', 'lazy',
+                'parallel', 'window')
+
+    def __init__(self, query, pool):
+        self.query = query
+        self.pool = pool
+
+    def _submit(self, func, *args, **kwargs):
+        return self.pool.apply_async(func, args, kwargs)
+
+    def get(self, **params):
+        return self._submit(self.query.get, **params)
+
+    def first(self, **params):
+        return self._submit(self.query.first, **params)
+
+    def count(self):
+        return self._submit(self.query.count)
+
+    def exists(self, **params):
+        return self._submit(self.query.exists, **params)
+
+    def delete(self):
+        return self._submit(self.query.delete)
+
+    def fetch(self):
+        '''
+        Returns a pending result of the list of instances
+        '''
+        return self._submit(list, self.query.iterator())
+
+    def clone(self, **params):
+        return type(self)(self.query.clone(**params), self.pool)
+
+    def iterator(self):
+        return self.iterate()
+
+    def __getattr__(self, name):
+        attr = getattr(self.query, name)
+        if not callable(attr):
+            return attr
+        if name in self.builders:
+            def build(*args, **kwargs):
+                return type(self)(attr(*args, **kwargs), self.pool)
+            return build
+
+        def submit(*args, **kwargs):
+            return self._submit(attr, *args, **kwargs)
+        return submit
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return type(self)(self.query[index], self.pool)
+        return self._submit(self.query.__getitem__, index)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, buffer_size=100):
+        '''
+        Yields instances while a worker loads the following ones, holding at
+        most buffer_size instances in reserve
+        '''
+        pending = Queue.Queue(maxsize=buffer_size)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                except Queue.Full:
+                    continue
+                return True
+            return False
+
+        def produce():
+            try:
+                for instance in self.query.iterator():
+                    if not put((instance, None)):
+                        return
+                put((finished, None))
+            except Exception:
+                put((None, sys.exc_info()))
+
+        self.pool.apply_async(produce)
+        try:
+            while True:
+                instance, error = pending.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if instance is finished:
+                    return
+                yield instance
+        finally:
+            stopped.set()
+
+
+class AsyncCollection(object):
+    '''
+    Wraps a collection so its calls return pending results instead of
+    blocking, the collection and its data store are shared with the caller
+    '''
+    def __init__(self, collection, workers=10, pool=None):
+        self.collection = collection
+        if pool is None:
+            pool = ThreadPool(workers)
+        self.pool = pool
+
+    def _submit(self, func, *args, **kwargs):
+        return self.pool.apply_async(func, args, kwargs)
+
+    def get_query(self, **params):
+        return AsyncCollectionQuery(self.collection.get_query(**params),
+                                    self.pool)
+
+    def get(self, pk, _default=None, **params):
+        return self._submit(self.collection.get, pk, _default, **params)
+
+    def get_many(self, keys):
+        return self._submit(self.collection.get_many, keys)
+
+    def first(self, **params):
+        return self.get_query(**params).first()
+
+    def find(self, **params):
+        return self.get_query(**params)
+
+    def all(self):
+        return self.get_query()
+
+    def exists(self, **params):
+        return self.get_query(**params).exists()
+
+    def count(self):
+        return self.get_query().count()
+
+    def create(self, **params):
+        return self._submit(self.collection.create, **params)
+
+    def save(self, instance, key=None):
+        return self._submit(self.collection.save, instance, key)
+
+    def save_many(self, instances, keys=None):
+        return self._submit(self.collection.save_many, instances, keys)
+
+    def remove(self, instance):
+        return self._submit(self.collection.remove, instance)
+
+    def remove_many(self, instances):
+        return self._submit(self.collection.remove_many, instances)
+
+    def delete(self):
+        return self.get_query().delete()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+'''
+Registry of the serializers data stores use to encode and decode payloads.
+The default codec is the fastest JSON implementation installed.
+'''
+from __future__ import absolute_import
+
+import json
+from decimal import Decimal
+
+
+class Codec(object):
+    def __init__(self, name, dumps, loads, content_type='application/json',
+                 iterdecode=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.content_type = content_type
+        self._iterdecode = iterdecode
+
+    def iterdecode(self, chunks, key=None):
+        '''
+        Yields the items of an encoded array as the chunks arrive, or of the
+        array under key when the payload is an object
+        '''
+        if self._iterdecode is None:
+            body = self.loads(''.join(chunks))
+            if key is not None:
+                body = body.get(key) or []
+            return iter(body)
+        return self._iterdecode(chunks, key)
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+
+class ChunkReader(object):
+    '''
+    File like wrapper around an iterable of chunks
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStream(object):
+    '''
+    Reads JSON tokens and values from an iterable of chunks, holding only the
+    unread part of the text in memory
+    '''
+    def __init__(self, chunks, decoder):
+        self.chunks = iter(chunks)
+        self.decoder = decoder
+        self.buf = ''
+        self.pos = 0
+        self.finished = False
+
+    def read(self):
+        try:
+            self.buf = self.buf[self.pos:] + next(self.chunks)
+        except StopIteration:
+            self.buf = self.buf[self.pos:]
+            self.finished = True
+        self.pos = 0
+
+    def peek(self):
+        '''
+        Returns the next character that isn't whitespace, None at the end
+        '''
+        while True:
+            buf = self.buf
+            while self.pos < len(buf) and buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(buf):
+                return buf[self.pos]
+            if self.finished:
+                return None
+            self.read()
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError('Expected %s, got %r' % (' or '.join(chars),
+                                                      char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        if self.peek() is None:
+            raise ValueError('Unexpected end of JSON')
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.finished:
+                    raise
+            else:
+                #a number ending the buffer or followed by its fraction or
+                #exponent may continue in the next chunk
+                number = isinstance(value, (int, long, float)) and \
+                    not isinstance(value, bool)
+                if self.finished or (end < len(self.buf) and not
+                                     (number and self.buf[end] in '.eE')):
+                    self.pos = end
+                    return value
+            self.read()
+
+
+def iter_json_array(chunks, key=None, decoder=json.JSONDecoder()):
+    '''
+    Incrementally decodes a JSON array, yielding each item once it has been
+    fully received. Only the current item is held in memory. When key is
+    given the array is read from that key of a top level object.
+    '''
+    stream = JSONStream(chunks, decoder)
+    if key is not None:
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            name = stream.decode()
+            stream.expect(':')
+            if name == key:
+                break
+            stream.decode()
+            if stream.expect(',}') == '}':
+                return
+    if stream.peek() == 'n' and key is not None:
+        if stream.decode() is not None:
+            raise ValueError('Expected a JSON array')
+        return
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.decode()
+        if stream.expect(',]') == ']':
+            return
+
+
+_registry = dict()
+_default = None
+
+
+def register_codec(codec, default=False):
+    global _default
+    _registry[codec.name] = codec
+    if default or _default is None:
+        _default = codec.name
+
+
+def get_codec(name=None):
+    '''
+    Returns the named codec, the default codec if name is None or name itself
+    if it is already a codec
+    '''
+    if isinstance(name, Codec):
+        return name
+    return _registry[name or _default]
+
+
+def available_codecs():
+    return sorted(_registry.keys())
+
+
+register_codec(Codec('json', json.dumps, json.loads,
+                     iterdecode=iter_json_array))
+
+try:
+    import simplejson
+except ImportError:
+    pass
+else:
+    register_codec(Codec('simplejson', simplejson.dumps, simplejson.loads,
+                         iterdecode=iter_json_array), default=True)
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_codec(Codec('ujson', ujson.dumps, ujson.loads,
+                         iterdecode=iter_json_array), default=True)
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    register_codec(Codec('orjson',
+                         lambda data: orjson.dumps(data).decode('utf-8'),
+                         orjson.loads, iterdecode=iter_json_array),
+                   default=True)
+
+try:
+    import ijson
+except ImportError:
+    pass
+else:
+    def undecimal(value):
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, dict):
+            return dict((key, undecimal(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [undecimal(item) for item in value]
+        return value
+
+    #prefer ijson's compiled parser for streaming whichever json codec won,
+    #numbers must decode as they do with loads
+    def ijson_iterdecode(chunks, key=None):
+        prefix = 'item' if key is None else '%s.item' % key
+        reader = ChunkReader(chunks)
+        try:
+            return ijson.items(reader, prefix, use_float=True)
+        except TypeError:
+            #ijson < 3.1 decodes every non integer number as a Decimal
+            return (undecimal(item) for item in ijson.items(reader, prefix))
+
+    for codec in _registry.values():
+        codec._iterdecode = ijson_iterdecode
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    #first bytes of fixarray, array 16 and array 32 headers
+    MSGPACK_ARRAYS = set(range(0x90, 0xa0) + [0xdc, 0xdd])
+
+    def msgpack_iterdecode(chunks, key=None):
+        if key is not None:
+            body = msgpack.unpackb(''.join(chunks), raw=False)
+            for item in body.get(key) or []:
+                yield item
+            return
+        chunks = iter(chunks)
+        head = ''
+        #an array header is at most 5 bytes
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 5:
+                break
+        if not head:
+            return
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(head)
+        if ord(head[:1]) in MSGPACK_ARRAYS:
+            #yield the items of a packed array rather than the array
+            unpacker.read_array_header()
+        #otherwise the items were sent as a sequence of packed objects
+        for item in unpacker:
+            yield item
+        for chunk in chunks:
+            unpacker.feed(chunk)
+            for item in unpacker:
+                yield item
+
+    register_codec(Codec('msgpack', msgpack.packb,
+                         lambda data: msgpack.unpackb(data, raw=False),
+                         content_type='application/x-msgpack',
+                         iterdecode=msgpack_iterdecode))
@@ -1,16 +1,92 @@
 # -*- coding: utf-8 -*-
+import itertools
+import threading
+from contextlib import contextmanager
+from copy import copy
+
 import micromodels
 
+from .datastores.core import UnsupportedOperation
+from .executors import get_executor
+
 
 class NotSet:
     pass
 
 
+class LazyInstance(object):
+    '''
+    Stands in for a model instance that is only loaded when needed. Declared
+    micromodels fields are converted one at a time on first access, anything
+    else loads the instance (running the afterInitialize hook) and proxies to
+    it.
+    '''
+    def __init__(self, collection, values):
+        object.__setattr__(self, '_collection', collection)
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_converted', dict())
+        object.__setattr__(self, '_instance', None)
+
+    def _load(self):
+        if self._instance is None:
+            instance = self._collection.data_store.load_instance(
+                self._collection, self._values)
+            object.__setattr__(self, '_instance', instance)
+        return self._instance
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            if name in self._converted:
+                return self._converted[name]
+            fields = getattr(self._collection.get_loader(), '_clsfields', {})
+            if name in fields:
+                field = copy(fields[name])
+                key = field.source or name
+                if key in self._values:
+                    field.populate(self._values[key])
+                else:
+                    field.populate(field.get_default())
+                self._converted[name] = field.to_python()
+                return self._converted[name]
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __repr__(self):
+        return '<LazyInstance %r>' % self._values
+
+
 class CollectionQuery(object):
+    #attributes carried over to clones
+    _state_attrs = ('ordering', 'limit', 'offset', 'result_mode',
+                    'result_fields', 'flat', 'only_fields', 'deferred_fields',
+                    'parallel_options')
 
     def __init__(self, collection, params):
         self.collection = collection
         self.params = params
+        self.ordering = ()
+        self.limit = None
+        self.offset = None
+        #instances, lazy, values or values_list
+        self.result_mode = 'instances'
+        self.result_fields = ()
+        self.flat = False
+        #projection requested from the data store
+        self.only_fields = ()
+        self.deferred_fields = ()
+        #how the data store may split the find across workers
+        self.parallel_options = None
         self._cache = dict()
 
     @property
@@ -26,14 +102,84 @@ class CollectionQuery(object):
             return self.clone(**params).get()
         if 'get' not in self._cache:
             result = self.data_store.get(self.collection, self.params)
-            self._cache['get'] = \
-                self.data_store.load_instance(self.collection, result)
+            self._cache['get'] = self._load_result(result)
         return self._cache['get']
 
+    def _find_options(self):
+        '''
+        Returns the keyword arguments passed to the data store find
+        '''
+        options = dict()
+        if self.ordering:
+            options['order_by'] = self.ordering
+        if self.limit is not None:
+            options['limit'] = self.limit
+        if self.offset:
+            options['offset'] = self.offset
+        if self.only_fields:
+            options['only'] = self.only_fields
+        if self.deferred_fields:
+            options['defer'] = self.deferred_fields
+        if self.parallel_options:
+            options['parallel'] = self.parallel_options
+        return options
+
+    def _get_field(self, result, field):
+        if field == 'pk' and self.collection.object_id_field:
+            field = self.collection.object_id_field
+        return result.get(field)
+
+    def _load_result(self, result):
+        '''
+        Returns the result in the form requested by the result mode
+        '''
+        if self.result_mode == 'values':
+            if not self.result_fields:
+                #stores may return the dictionaries they hold and index
+                return dict(result)
+            return dict((field, self._get_field(result, field))
+                        for field in self.result_fields)
+        if self.result_mode == 'values_list':
+            if not self.result_fields:
+                return tuple(result[field]
+                             for field in self._stored_fields(result))
+            if self.flat:
+                return self._get_field(result, self.result_fields[0])
+            return tuple(self._get_field(result, field)
+                         for field in self.result_fields)
+        if self.result_mode == 'lazy':
+            return LazyInstance(self.collection, result)
+        return self.data_store.load_instance(self.collection, result)
+
+    def _stored_fields(self, result):
+        '''
+        Returns the fields of a stored dictionary in a stable order: the
+        object id, the fields the model declares, then the others by name
+        '''
+        id_field = self.collection.object_id_field
+        declared = getattr(self.collection.get_loader(), '_clsfields', {})
+        fields = [field for field in declared
+                  if field in result and field != id_field]
+        fields.extend(sorted(field for field in result
+                             if field != id_field and field not in declared))
+        if id_field in result:
+            fields.insert(0, id_field)
+        return fields
+
+    def _get_results(self):
+        options = self._find_options()
+        if self.params or options:
+            return self.data_store.find(self.collection, self.params,
+                                        **options)
+        return self.data_store.all(self.collection)
+
+    def _fetch(self):
+        if 'results' not in self._cache:
+            self._cache['results'] = enumerate(self._get_results())
+
     def __iter__(self):
         self._cache.setdefault('objects', dict())
-        if 'results' not in self._cache:
-            self.find()
+        self._fetch()
 
         #yield cached objects
         index = 0
@@ -44,74 +190,199 @@ class CollectionQuery(object):
         #yield objects not yet loaded
         for index, result in self._cache['results']:
             if index not in self._cache['objects']:  # redundant
-                self._cache['objects'][index] = \
-                    self.data_store.load_instance(self.collection, result)
+                self._cache['objects'][index] = self._load_result(result)
             yield self._cache['objects'][index]
 
+    def iterator(self):
+        '''
+        Iterates over the results without caching the loaded instances
+        '''
+        for result in self._get_results():
+            yield self._load_result(result)
+
     def __getitem__(self, index):
-        #TODO communicate to backend so that we don't fetch more then we need
         self._cache.setdefault('objects', dict())
-        if 'results' not in self._cache:
-            self.find()
         if isinstance(index, slice):
-            def sliced_gen():
-                for y, obj in enumerate(iter(self)):
-                    if y >= index.start and y < index.stop:
-                        yield obj
-            return sliced_gen()
+            if index.step not in (None, 1):
+                raise ValueError('Query slicing does not support steps')
+            start, stop = index.start or 0, index.stop
+            if start < 0 or (stop is not None and stop < 0):
+                raise ValueError('Query slicing does not support negative '
+                                 'indexes')
+            if stop is not None:
+                stop = max(start, stop)
+            return self.window(start, stop)
+        if index < 0:
+            raise ValueError('Query indexing does not support negative '
+                             'indexes')
+        if index in self._cache['objects']:
+            return self._cache['objects'][index]
+        if 'results' in self._cache:
+            for y, obj in enumerate(iter(self)):
+                if y == index:
+                    return obj
         else:
-            if index in self._cache['objects']:
-                return self._cache['objects'][index]
-            else:
-                for y, obj in enumerate(iter(self)):
-                    if y == index:
-                        return obj
+            for obj in self.window(index, index + 1):
+                return obj
         raise KeyError('Not found: %s' % index)
 
+    def window(self, start, stop=None):
+        '''
+        Returns a query limited to the results from start up to stop, relative
+        to the current window
+        '''
+        query = self.clone()
+        query.offset = (self.offset or 0) + start
+        if stop is not None:
+            query.limit = stop - start
+        if self.limit is not None:
+            remaining = max(0, self.limit - start)
+            if query.limit is None or query.limit > remaining:
+                query.limit = remaining
+        return query
+
     def __len__(self):
         return self.count()
 
     def find(self, **params):
         if params:
             return self.clone(**params).find()
-        if not self.params:
-            return self.all()
-        if 'results' not in self._cache:
-            results = self.data_store.find(self.collection, self.params)
-            self._cache['results'] = enumerate(results)
+        self._fetch()
         return iter(self)
 
     def first(self, **params):
         if params:
             return self.clone(**params).first()
-        if not self.params:
-            return self.all().next()
-        if 'results' not in self._cache:
-            results = self.data_store.find(self.collection, self.params)
-            self._cache['results'] = enumerate(results)
+        self._fetch()
         try:
             return iter(self).next()
         except StopIteration:
             return None
 
     def all(self):
-        if self.params:
-            return self.find()
-        if 'results' not in self._cache:
-            results = self.data_store.all(self.collection)
-            self._cache['results'] = enumerate(results)
+        self._fetch()
         return iter(self)
 
+    def values(self, *fields):
+        '''
+        Returns a query yielding the stored dictionaries without loading
+        instances, limited to the fields if any are given
+        '''
+        query = self.clone()
+        query.result_mode = 'values'
+        query.result_fields = fields
+        return query
+
+    def values_list(self, *fields, **kwargs):
+        '''
+        Returns a query yielding tuples of the field values, or the values
+        themselves if flat=True is passed with a single field. Without fields
+        the tuples hold every stored field, the object id first, then the
+        fields the model declares and the others sorted by name.
+        '''
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % kwargs.keys())
+        if flat and len(fields) != 1:
+            raise TypeError('flat=True requires a single field')
+        query = self.clone()
+        query.result_mode = 'values_list'
+        query.result_fields = fields
+        query.flat = flat
+        return query
+
+    def lazy(self):
+        '''
+        Returns a query yielding LazyInstances which convert fields on access
+        '''
+        query = self.clone()
+        query.result_mode = 'lazy'
+        return query
+
+    def only(self, *fields):
+        '''
+        Returns a query that only fetches the fields (and the object id)
+        from the data store
+        '''
+        query = self.clone()
+        query.only_fields = fields
+        return query
+
+    def defer(self, *fields):
+        '''
+        Returns a query that does not fetch the fields from the data store
+        '''
+        query = self.clone()
+        query.deferred_fields = self.deferred_fields + fields
+        return query
+
+    def parallel(self, executor='process', workers=None, chunk_size=1000,
+                 ordered=True):
+        '''
+        Returns a query the data store may evaluate in chunks of chunk_size
+        objects with the executor: 'serial', 'thread', 'process' or an
+        executor instance. Unordered results are returned as chunks complete.
+        '''
+        query = self.clone()
+        query.parallel_options = {
+            'executor': get_executor(executor, workers),
+            'chunk_size': chunk_size,
+            'ordered': ordered,
+        }
+        return query
+
+    def order_by(self, *fields):
+        '''
+        Returns a query ordered by the fields, `-` prefixed fields descending
+        '''
+        query = self.clone()
+        query.ordering = tuple(fields)
+        return query
+
     def delete(self):
+        if self.limit is not None or self.offset:
+            raise UnsupportedOperation('Cannot delete a sliced query')
+        #writes buffered before the delete must not be applied after it
+        self.collection.flush_writes()
         return self.data_store.delete(self.collection, self.params)
 
     def count(self):
         if 'count' not in self._cache:
-            self._cache['count'] = \
-                self.data_store.count(self.collection, self.params)
+            count = self.data_store.count(self.collection, self.params)
+            if self.offset:
+                count = max(0, count - self.offset)
+            if self.limit is not None:
+                count = min(count, self.limit)
+            self._cache['count'] = count
         return self._cache['count']
 
+    def aggregate(self, group_by=None, **aggregations):
+        '''
+        Aggregates the matching objects, each keyword names a (function,
+        field) pair where function is one of count, sum, min, max or mean:
+
+            query.aggregate(total=('sum', 'price'), n=('count', 'pk'))
+            query.aggregate(group_by='kind', oldest=('max', 'age'))
+
+        Returns a dictionary of the aggregates, or with group_by (a field or
+        a tuple of fields) a list of dictionaries per group.
+        '''
+        if self.limit is not None or self.offset:
+            raise UnsupportedOperation('Cannot aggregate a sliced query')
+        if isinstance(group_by, basestring):
+            group_by = (group_by,)
+        return self.data_store.aggregate(self.collection, self.params,
+                                         aggregations, tuple(group_by or ()))
+
+    def explain(self):
+        '''
+        Returns the plan the data store would use to answer the query
+        '''
+        return self.data_store.explain(self.collection, self.params)
+
     def keys(self):
+        if self.limit is not None or self.offset:
+            raise UnsupportedOperation('Cannot list the keys of a sliced query')
         if 'keys' not in self._cache:
             self._cache['keys'] = \
                 self.data_store.keys(self.collection, self.params)
@@ -121,14 +392,22 @@ class CollectionQuery(object):
         if params:
             return self.clone(**params).exists()
         if 'exists' not in self._cache:
-            self._cache['exists'] = \
-                self.data_store.exists(self.collection, self.params)
+            if self.limit == 0:
+                self._cache['exists'] = False
+            elif self.offset:
+                self._cache['exists'] = bool(self.count())
+            else:
+                self._cache['exists'] = \
+                    self.data_store.exists(self.collection, self.params)
         return self._cache['exists']
 
     def clone(self, **params):
         new_params = dict(self.params)
         new_params.update(params)
-        return type(self)(self.collection, new_params)
+        query = type(self)(self.collection, new_params)
+        for attr in self._state_attrs:
+            setattr(query, attr, getattr(self, attr))
+        return query
 
 
 class CRUDHooks(object):
@@ -166,6 +445,10 @@ class BaseCollection(CRUDHooks):
     object_id_field = None
     id_generator = None
     params = dict()
+    #fields the data store may maintain secondary indexes on
+    indexes = ()
+    #fields the data store may keep ordered for range lookups and ordering
+    sorted_indexes = ()
 
     def get_query(self, **params):
         if self.params:
@@ -189,12 +472,15 @@ class BaseCollection(CRUDHooks):
 
     ## Dictionary like methods ##
 
-    def __setitem__(self, key, instance):
+    def _set_object_id(self, instance, key):
         if self.object_id_field:
             if hasattr(instance, '__setitem__'):
                 instance[self.object_id_field] = key
             elif hasattr(instance, self.object_id_field):
                 setattr(instance, self.object_id_field, key)
+
+    def __setitem__(self, key, instance):
+        self._set_object_id(instance, key)
         return self.save(instance, key)
 
     def __getitem__(self, key):
@@ -216,17 +502,22 @@ class BaseCollection(CRUDHooks):
         return self.all()
 
     def items(self):
-        #TODO make efficient
-        for key in self.keys():
-            yield (key, self.get(key))
+        keys = list(self.keys())
+        instances = self.get_many(keys)
+        for key in keys:
+            if key in instances:
+                yield (key, instances[key])
 
     def extend(self, items):
-        for item in items:
-            self.save(item)
+        self.save_many(list(items))
 
     def update(self, items):
-        for key, value in items.items():
-            self[key] = value
+        keys, instances = list(), list()
+        for key, instance in items.items():
+            self._set_object_id(instance, key)
+            keys.append(key)
+            instances.append(instance)
+        self.save_many(instances, keys)
 
     def pop(self, key, default=NotSet):
         try:
@@ -264,6 +555,14 @@ class BaseCollection(CRUDHooks):
         except (KeyError, IndexError):
             return _default
 
+    def get_many(self, keys):
+        '''
+        Returns a dictionary of key => instance for the keys that exist
+        '''
+        results = self.data_store.get_many(self, keys)
+        return dict((key, self.data_store.load_instance(self, result))
+                    for key, result in results.items())
+
     ## Query Methods ##
 
     def first(self, **params):
@@ -299,12 +598,92 @@ class BaseCollection(CRUDHooks):
         instance = self.new(**params)
         return self.save(instance)
 
+    def _get_pending_writes(self):
+        '''
+        Returns the list of (operation, instance, key) writes buffered by the
+        unit_of_work of the current thread, None outside of one
+        '''
+        local = self.__dict__.setdefault('_unit_of_work', threading.local())
+        return getattr(local, 'writes', None)
+
+    def _set_pending_writes(self, writes):
+        local = self.__dict__.setdefault('_unit_of_work', threading.local())
+        local.writes = writes
+
     def save(self, instance, key=None):
+        writes = self._get_pending_writes()
+        if writes is not None:
+            writes.append(('save', instance, key))
+            return instance
         return self.data_store.save(self, instance, key)
 
+    @contextmanager
+    def unit_of_work(self):
+        '''
+        Buffers the saves and removes made by the current thread within the
+        block and flushes them in order, each run of saves or removes with a
+        single save_many or remove_many, once the block exits without an
+        error. Query deletes flush the buffered writes before running.
+        '''
+        if self._get_pending_writes() is not None:
+            #nested blocks are flushed by the outermost one
+            yield self
+            return
+        self._set_pending_writes(list())
+        try:
+            yield self
+            self.flush_writes()
+        finally:
+            #the buffered writes are dropped if the block failed
+            self._set_pending_writes(None)
+
+    def flush_writes(self):
+        '''
+        Writes the saves and removes buffered by the unit_of_work of the
+        current thread
+        '''
+        writes = self._get_pending_writes()
+        if not writes:
+            return
+        self._set_pending_writes(list())
+        for operation, run in itertools.groupby(writes, lambda w: w[0]):
+            run = list(run)
+            instances = [instance for operation, instance, key in run]
+            if operation == 'save':
+                keys = [key for operation, instance, key in run]
+                self.data_store.save_many(self, instances, keys)
+            else:
+                self.data_store.remove_many(self, instances)
+
     def remove(self, instance):
+        writes = self._get_pending_writes()
+        if writes is not None:
+            writes.append(('remove', instance, None))
+            return instance
         return self.data_store.remove(self, instance)
 
+    def save_many(self, instances, keys=None):
+        '''
+        Saves a batch of instances, hooks are published once for the batch
+        '''
+        writes = self._get_pending_writes()
+        if writes is not None:
+            instances = list(instances)
+            if keys is None:
+                keys = [None] * len(instances)
+            writes.extend(('save', instance, key)
+                          for instance, key in zip(instances, keys))
+            return instances
+        return self.data_store.save_many(self, instances, keys)
+
+    def remove_many(self, instances):
+        writes = self._get_pending_writes()
+        if writes is not None:
+            instances = list(instances)
+            writes.extend(('remove', instance, None) for instance in instances)
+            return instances
+        return self.data_store.remove_many(self, instances)
+
     def all(self):
         return self.get_query()
 
@@ -325,7 +704,8 @@ class RawCollection(BaseCollection):
     object_id_field = 'id'
 
     def __init__(self, data_store=None, model=dict, name=None,
-                 object_id_field=None, id_generator=None, params=None):
+                 object_id_field=None, id_generator=None, params=None,
+                 indexes=None, sorted_indexes=None):
         if data_store is None:
             from .datastores import MemoryDataStore
             data_store = MemoryDataStore
@@ -339,6 +719,10 @@ class RawCollection(BaseCollection):
             self.object_id_field = object_id_field
         if id_generator:
             self.id_generator = id_generator
+        if indexes:
+            self.indexes = tuple(indexes)
+        if sorted_indexes:
+            self.sorted_indexes = tuple(sorted_indexes)
         super(RawCollection, self).__init__()
 
     ## Hooks ##
@@ -359,12 +743,14 @@ class Collection(RawCollection):
     A collection bound to a schema and returns model instances
     '''
     def __init__(self, model, data_store=None, name=None,
-                 object_id_field=None, id_generator=None, params=None):
+                 object_id_field=None, id_generator=None, params=None,
+                 indexes=None, sorted_indexes=None):
         if name is None:
             name = model.__name__
         super(Collection, self).__init__(model=model, data_store=data_store,
             name=name, object_id_field=object_id_field,
-            id_generator=id_generator, params=params,)
+            id_generator=id_generator, params=params, indexes=indexes,
+            sorted_indexes=sorted_indexes,)
 
     def prepare_model(self, model):
         '''
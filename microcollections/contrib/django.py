@@ -1,40 +1,141 @@
 # -*- coding: utf-8 -*-
-import json
+from __future__ import absolute_import
 
+import django
+from django.db import transaction
+
+from microcollections.codecs import get_codec
 from microcollections.datastores.core import BaseDataStore
 
 
 class DjangoTableDataStore(BaseDataStore):
     def __init__(self, table,
             seeker=lambda col, pk: {'collection': col, 'identifier': pk},
-            setter=lambda x: {'data': json.dumps(x)},
-            getter=lambda obj: json.loads(obj.data)):
+            setter=None, getter=None,
+            key_field='identifier', columns=('data',), codec=None,
+            unique_fields=None, batch_size=None, chunk_size=None):
+        '''
+        By default payloads are encoded into the `data` column with the
+        named codec, the fastest installed JSON codec if none is given.
+
+        key_field names the column the seeker stores the pk in, it is used to
+        look up batches of objects at once
+
+        columns names the columns the getter reads, projected queries only
+        load those from the table
+
+        unique_fields names the columns of the unique constraint the seeker's
+        lookup matches. When given (and supported, Django >= 4.1) save_many
+        upserts with a single bulk_create(update_conflicts=True) instead of
+        selecting the existing rows first. batch_size caps the rows written
+        per statement.
+
+        When chunk_size is set find and keys stream rows instead of filling
+        the result cache. Unordered, unsliced queries are read in batches of
+        chunk_size rows by primary key ranges so at most a batch is held in
+        memory, whatever the database driver buffers. Other queries stream
+        with QuerySet.iterator().
+        '''
         super(DjangoTableDataStore, self).__init__()
         self.table = table
         self.manager = table.objects
+        self.codec = codec = get_codec(codec)
+        if setter is None:
+            setter = lambda x: {'data': codec.dumps(x)}
+        if getter is None:
+            getter = lambda obj: codec.loads(obj.data)
         self.seeker = seeker
         self.setter = setter
         self.getter = getter
+        self.key_field = key_field
+        self.columns = columns
+        self.unique_fields = unique_fields
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+    def _bulk_lookup(self, collection, pks):
+        '''
+        Returns the filter arguments matching every pk in a single query
+        '''
+        lookup = self.seeker(collection, None)
+        lookup.pop(self.key_field)
+        lookup['%s__in' % self.key_field] = list(pks)
+        return lookup
+
+    def _db_key(self, pk):
+        '''
+        Returns pk as the key field reads it back from the database, so
+        rows can be matched with the pks they were looked up by
+        '''
+        return self.table._meta.get_field(self.key_field).to_python(pk)
 
     def save(self, collection, instance, key=None):
         instance = self.execute_hooks('beforeSave',
             {'instance': instance, 'collection': collection})
-        pk = key or collection.get_object_id(instance)
+        if key is None:
+            key = collection.get_object_id(instance)
         payload = collection.get_serializable(instance)
-        lookup = self.seeker(collection, pk)
-        properties = self.setter(payload)
-        try:
-            entry = self.manager.get(**lookup)
-        except self.table.DoesNotExist:
-            lookup.update(properties)
-            entry = self.manager.create(**lookup)
-        else:
-            for k, v in properties.items():
-                setattr(entry, k, v)
-            entry.save()
+        lookup = self.seeker(collection, key)
+        self.manager.update_or_create(defaults=self.setter(payload), **lookup)
         return self.execute_hooks('afterSave',
             {'instance': instance, 'collection': collection})
 
+    def save_many(self, collection, instances, keys=None):
+        instances = self.execute_batch_hooks('beforeSave', collection,
+                                             list(instances))
+        if keys is None:
+            keys = [None] * len(instances)
+        properties = dict()
+        for instance, key in zip(instances, keys):
+            if key is None:
+                key = collection.get_object_id(instance)
+            properties[self._db_key(key)] = self.setter(collection.get_serializable(instance))
+        with transaction.atomic(using=self.manager.db):
+            #bulk_create(update_conflicts=True) needs django >= 4.1
+            if self.unique_fields and django.VERSION >= (4, 1):
+                self._upsert(collection, properties)
+            else:
+                self._update_or_create(collection, properties)
+        return self.execute_batch_hooks('afterSave', collection, instances)
+
+    def _upsert(self, collection, properties):
+        entries, fields = list(), set()
+        for pk, props in properties.items():
+            lookup = self.seeker(collection, pk)
+            lookup.update(props)
+            fields.update(props.keys())
+            entries.append(self.table(**lookup))
+        self.manager.bulk_create(entries, batch_size=self.batch_size,
+                                 update_conflicts=True,
+                                 unique_fields=list(self.unique_fields),
+                                 update_fields=list(fields))
+
+    def _update_or_create(self, collection, properties):
+        existing = self.manager.filter(**self._bulk_lookup(collection,
+                                                           properties.keys()))
+        updated, fields = list(), set()
+        for entry in existing:
+            pk = getattr(entry, self.key_field)
+            for k, v in properties.pop(pk).items():
+                setattr(entry, k, v)
+                fields.add(k)
+            updated.append(entry)
+        created = list()
+        for pk, props in properties.items():
+            lookup = self.seeker(collection, pk)
+            lookup.update(props)
+            created.append(self.table(**lookup))
+        if updated and hasattr(self.manager, 'bulk_update'):
+            self.manager.bulk_update(updated, list(fields),
+                                     batch_size=self.batch_size)
+        elif updated:
+            #bulk_update needs django >= 2.2, the caller's transaction still
+            #commits the updates together
+            for entry in updated:
+                entry.save(update_fields=list(fields))
+        if created:
+            self.manager.bulk_create(created, batch_size=self.batch_size)
+
     def remove(self, collection, instance):
         instance = self.execute_hooks('beforeRemove',
             {'instance': instance, 'collection': collection})
@@ -44,27 +145,98 @@ class DjangoTableDataStore(BaseDataStore):
         return self.execute_hooks('afterRemove',
             {'instance': instance, 'collection': collection})
 
+    def remove_many(self, collection, instances):
+        instances = self.execute_batch_hooks('beforeRemove', collection,
+                                             list(instances))
+        pks = [collection.get_object_id(instance) for instance in instances]
+        self.manager.filter(**self._bulk_lookup(collection, pks)).delete()
+        return self.execute_batch_hooks('afterRemove', collection, instances)
+
     def _normalize_params(self, collection, params):
         params = super(DjangoTableDataStore, self)._normalize_params(collection, params)
         if 'pk' in params:
             params.update(self.seeker(collection, params.pop('pk')))
         if 'pk__in' in params:
-            new_lookups = list()
-            for pk in params['pk__in']:
-                new_lookups.append(self.seeker(collection, pk))
-            params['pk__in'] = new_lookups
+            params.update(self._bulk_lookup(collection, params.pop('pk__in')))
         return params
 
     def get(self, collection, params):
         params = self._normalize_params(collection, params)
         return self.getter(self.manager.get(**params))
 
-    def find(self, collection, params):
+    def get_many(self, collection, pks):
+        pks = dict((self._db_key(pk), pk) for pk in pks)
+        entries = self.manager.filter(**self._bulk_lookup(collection, pks))
+        return dict((pks[getattr(entry, self.key_field)], self.getter(entry))
+                    for entry in entries)
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        params = self._normalize_params(collection, params)
+        queryset = self.manager.filter(**params)
+        if order_by:
+            queryset = queryset.order_by(*order_by)
+        if limit is not None:
+            queryset = queryset[offset or 0:(offset or 0) + limit]
+        elif offset:
+            queryset = queryset[offset:]
+        projected = (only or defer) and self.columns
+        if projected:
+            queryset = queryset.only(*self.columns)
+        if self.chunk_size:
+            if order_by or limit is not None or offset:
+                entries = queryset.iterator()
+            else:
+                entries = self._iter_chunks(queryset)
+            results = (self.getter(entry) for entry in entries)
+            if not projected:
+                return results
+            return self._project_results(collection, results, only, defer)
+        if projected:
+            return [self._project(collection, self.getter(entry), only, defer)
+                    for entry in queryset]
+        return map(self.getter, queryset)
+
+    def _iter_chunks(self, queryset, get_pk=lambda entry: entry.pk):
+        '''
+        Yields the entries of an unordered queryset with a query per
+        chunk_size entries, each starting after the last primary key read
+        '''
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk[:self.chunk_size])
+            for entry in chunk:
+                yield entry
+            if len(chunk) < self.chunk_size:
+                return
+            last_pk = get_pk(chunk[-1])
+
+    def count(self, collection, params):
+        params = self._normalize_params(collection, params)
+        return self.manager.filter(**params).count()
+
+    def exists(self, collection, params):
+        params = self._normalize_params(collection, params)
+        return self.manager.filter(**params).exists()
+
+    def keys(self, collection, params):
         params = self._normalize_params(collection, params)
-        return map(self.getter, self.manager.filter(**params))
+        queryset = self.manager.filter(**params)
+        if self.chunk_size:
+            rows = queryset.values_list('pk', self.key_field)
+            rows = self._iter_chunks(rows, get_pk=lambda row: row[0])
+            return (key for pk, key in rows)
+        return iter(queryset.values_list(self.key_field, flat=True))
 
     def delete(self, collection, params):
         params = self._normalize_params(collection, params)
-        self.manager.filter(**params).delete()
-        return self.execute_hooks('afterDelete',
-            {'collection': collection})
+        deleted = self.manager.filter(**params).delete()
+        if isinstance(deleted, tuple):
+            #django >= 1.9 returns (total, per model counts)
+            deleted = deleted[0]
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return deleted
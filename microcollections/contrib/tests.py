@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the Django data store against an in-memory sqlite database,
+skipped when Django is not installed
+'''
+from __future__ import absolute_import
+
+import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+
+from microcollections.collections import RawCollection
+
+
+if django is not None:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+    django.setup()
+
+    from django.db import connection, models
+    from django.test.utils import CaptureQueriesContext
+
+    from microcollections.contrib.django import DjangoTableDataStore
+
+    class TextEntry(models.Model):
+        collection = models.CharField(max_length=64)
+        identifier = models.CharField(max_length=64)
+        data = models.TextField()
+
+        class Meta:
+            app_label = 'microcollections'
+
+    class IntegerEntry(models.Model):
+        collection = models.CharField(max_length=64)
+        identifier = models.IntegerField()
+        data = models.TextField()
+
+        class Meta:
+            app_label = 'microcollections'
+
+
+@unittest.skipUnless(django, 'django is not installed')
+class TestDjangoTableDataStore(unittest.TestCase):
+    table_name = 'TextEntry'
+    ids = ['obj0', 'obj1', 'obj2', 'obj3', 'obj4']
+
+    def setUp(self):
+        self.table = globals()[self.table_name]
+        with connection.schema_editor() as editor:
+            editor.create_model(self.table)
+        self.collection = self.get_collection()
+        self.collection.extend([{'id': pk, 'kind': 'ab'[i % 2]}
+                                for i, pk in enumerate(self.ids)])
+
+    def tearDown(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(self.table)
+
+    def get_collection(self, name='things', **options):
+        data_store = DjangoTableDataStore(self.table,
+            seeker=lambda col, pk: {'collection': col.name, 'identifier': pk},
+            **options)
+        return RawCollection(data_store, name=name,
+                             params={'collection': name})
+
+    def test_save_many(self):
+        self.assertEqual(self.table.objects.count(), 5)
+        self.collection.extend([{'id': self.ids[0], 'kind': 'c'},
+                                {'id': self.ids[1], 'kind': 'c'}])
+        self.assertEqual(self.table.objects.count(), 5)
+        self.assertEqual(self.collection[self.ids[0]]['kind'], 'c')
+        self.assertEqual(self.collection[self.ids[2]]['kind'], 'a')
+        #another collection in the same table
+        self.get_collection('others').extend([{'id': self.ids[0]}])
+        self.assertEqual(self.table.objects.count(), 6)
+        self.assertEqual(len(self.collection), 5)
+
+    def test_keys_of_another_type(self):
+        #rows are matched with keys of the column's type
+        collection = self.get_collection('others')
+        collection.extend([{'id': 0, 'kind': 'a'}, {'id': 1, 'kind': 'a'}])
+        collection.extend([{'id': 0, 'kind': 'b'}, {'id': 1, 'kind': 'b'}])
+        self.assertEqual(self.table.objects.count(), 7)
+        results = collection.get_many([0, 1])
+        self.assertEqual(sorted(results.keys()), [0, 1])
+        self.assertEqual(results[0]['kind'], 'b')
+
+    def test_remove_many(self):
+        self.collection.remove_many([self.collection[self.ids[0]],
+                                     self.collection[self.ids[3]]])
+        self.assertEqual(sorted(self.collection.keys()),
+                         sorted(self.ids[1:3] + self.ids[4:]))
+
+    def test_delete_count(self):
+        query = self.collection.find(id__in=self.ids[:2])
+        self.assertEqual(query.delete(), 2)
+        self.assertEqual(self.collection.delete(), 3)
+        self.assertEqual(len(self.collection), 0)
+
+    def test_get_many(self):
+        results = self.collection.get_many([self.ids[1], self.ids[3]])
+        self.assertEqual(sorted(results.keys()),
+                         sorted([self.ids[1], self.ids[3]]))
+        self.assertEqual(results[self.ids[3]]['kind'], 'b')
+
+    def test_only_defer(self):
+        query = self.collection.find(id=self.ids[1])
+        self.assertEqual(list(query.only('kind')),
+                         [{'id': self.ids[1], 'kind': 'b'}])
+        self.assertEqual(list(query.defer('kind')), [{'id': self.ids[1]}])
+
+    def test_count_exists_keys(self):
+        self.assertEqual(self.collection.find(id__in=self.ids[:2]).count(), 2)
+        self.assertTrue(self.collection.exists(id=self.ids[4]))
+        self.assertFalse(self.get_collection('others').exists())
+        self.assertEqual(sorted(self.collection.keys()), sorted(self.ids))
+
+    def test_chunked_iteration(self):
+        collection = self.get_collection(chunk_size=2)
+        with CaptureQueriesContext(connection) as queries:
+            ids = [obj['id'] for obj in collection.all()]
+        #two full chunks and the last, short one
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(sorted(ids), sorted(self.ids))
+        with CaptureQueriesContext(connection) as queries:
+            keys = list(collection.keys())
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(sorted(keys), sorted(self.ids))
+
+
+class TestDjangoIntegerKeys(TestDjangoTableDataStore):
+    table_name = 'IntegerEntry'
+    ids = [0, 1, 2, 3, 4]
+
@@ -1,3 +1,8 @@
 # -*- coding: utf-8 -*-
 from .core import BaseDataStore, UnsupportedOperation
-from .memory import MemoryDataStore
\ No newline at end of file
+from .memory import MemoryDataStore
+from .caching import CachingDataStore, SharedCache
+from .sqlite import SQLiteDataStore
+from .log import LogDataStore
+from .sharded import ShardedDataStore
+from .columnar import ColumnarMemoryDataStore
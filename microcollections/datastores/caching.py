@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+import copy
+import cPickle as pickle
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .core import BaseDataStore
+
+
+NotFound = object()
+
+
+def freeze(value):
+    '''
+    Returns a hashable equivalent of query params and options
+    '''
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(freeze(item) for item in value)
+    hash(value)
+    return value
+
+
+class LRUCache(object):
+    '''
+    A thread safe mapping that evicts the least recently used entries past
+    maxsize and entries older than ttl seconds
+    '''
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=NotFound):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                self.evictions += 1
+                return default
+            #re-insert as the most recently used
+            self.entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not NotFound
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedCache(object):
+    '''
+    A cache tier shared by every process on the host through a sqlite file.
+    Invalidations are appended to a log the processes poll, so local caches
+    in other processes can drop the same entries.
+    '''
+    #how often expired entries, least recently used entries past maxsize
+    #and old invalidations are purged, in writes
+    purge_every = 100
+    #hits are written back to the access times in batches of this many
+    touch_every = 100
+    #invalidations older than this many seconds are purged from the log
+    log_retention = 3600
+
+    def __init__(self, path, maxsize=100000, ttl=None, timeout=5.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timeout = timeout
+        self.local = threading.local()
+        self.writes = 0
+        self.touched = dict()
+        self.lock = threading.Lock()
+        self._setup()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.text_factory = str
+        return connection
+
+    def _get_connection(self):
+        '''
+        Returns a connection for the current thread, reconnecting in forked
+        processes
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = self._connect()
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _setup(self):
+        connection = self._get_connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                           'namespace TEXT, key TEXT, value BLOB, '
+                           'expires REAL, accessed REAL, '
+                           'PRIMARY KEY (namespace, key))')
+        connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed '
+                           'ON entries (accessed)')
+        connection.execute('CREATE TABLE IF NOT EXISTS invalidations ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'namespace TEXT, key TEXT, created REAL)')
+
+    def encode_key(self, key):
+        return repr(key)
+
+    def get(self, namespace, key, default=NotFound):
+        connection = self._get_connection()
+        now = time.time()
+        row = connection.execute('SELECT value, expires FROM entries '
+                                 'WHERE namespace = ? AND key = ?',
+                                 (namespace, self.encode_key(key))).fetchone()
+        if row is None or (row[1] is not None and row[1] < now):
+            return default
+        with self.lock:
+            self.touched[(namespace, self.encode_key(key))] = now
+            flush = len(self.touched) >= self.touch_every
+        if flush:
+            self.flush_access_times()
+        return pickle.loads(str(row[0]))
+
+    def flush_access_times(self):
+        '''
+        Writes the access times of the entries hit since the last flush
+        '''
+        with self.lock:
+            touched, self.touched = self.touched, dict()
+        self._get_connection().executemany(
+            'UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?',
+            [(accessed, namespace, key)
+             for (namespace, key), accessed in touched.items()])
+
+    def set(self, namespace, key, value):
+        connection = self._get_connection()
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        payload = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        connection.execute('INSERT OR REPLACE INTO entries '
+                           '(namespace, key, value, expires, accessed) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (namespace, self.encode_key(key), payload,
+                            expires, now))
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge()
+
+    def invalidate(self, namespace, key=NotFound):
+        '''
+        Drops the entry, or the whole namespace if no key is given, and logs
+        the invalidation for the other processes
+        '''
+        self.invalidate_many([(namespace, key)])
+
+    def invalidate_many(self, invalidations):
+        '''
+        Drops the entries of (namespace, key) pairs, whole namespaces for
+        pairs without a key, logging one invalidation per distinct pair in a
+        single transaction
+        '''
+        namespaces, keys = set(), set()
+        for namespace, key in invalidations:
+            if key is NotFound:
+                namespaces.add(namespace)
+            else:
+                keys.add((namespace, self.encode_key(key)))
+        keys = [(namespace, key) for namespace, key in keys
+                if namespace not in namespaces]
+        now = time.time()
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('DELETE FROM entries WHERE namespace = ?',
+                                   [(namespace,) for namespace in namespaces])
+            connection.executemany('DELETE FROM entries '
+                                   'WHERE namespace = ? AND key = ?', keys)
+            connection.executemany('INSERT INTO invalidations '
+                                   '(namespace, key, created) '
+                                   'VALUES (?, ?, ?)',
+                                   [(namespace, None, now)
+                                    for namespace in namespaces] +
+                                   [(namespace, key, now)
+                                    for namespace, key in keys])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def last_invalidation(self):
+        row = self._get_connection().execute(
+            'SELECT MAX(id) FROM invalidations').fetchone()
+        return row[0] or 0
+
+    def invalidations_since(self, last_id):
+        '''
+        Returns the (id, namespace, encoded key or None) invalidations logged
+        after last_id
+        '''
+        return self._get_connection().execute(
+            'SELECT id, namespace, key FROM invalidations WHERE id > ? '
+            'ORDER BY id', (last_id,)).fetchall()
+
+    def purge(self):
+        self.flush_access_times()
+        connection = self._get_connection()
+        now = time.time()
+        connection.execute('DELETE FROM entries WHERE expires < ?', (now,))
+        connection.execute('DELETE FROM invalidations WHERE created < ?',
+                           (now - self.log_retention,))
+        if self.maxsize is not None:
+            connection.execute('DELETE FROM entries WHERE rowid IN ('
+                               'SELECT rowid FROM entries '
+                               'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                               (self.maxsize,))
+
+
+class CachingDataStore(BaseDataStore):
+    '''
+    Wraps a data store, caching gets by pk and finds, counts and existence
+    checks by their params. Entries are invalidated by the save, remove and
+    delete events the wrapped store publishes.
+
+    An optional SharedCache is consulted on local misses before the wrapped
+    store. Invalidations logged by other processes are applied to the local
+    cache at most sync_interval seconds after they happen, the shared cache
+    is polled for them at most that often.
+
+    maxsize caps the entries cached per collection for objects and for
+    queries, whatever their size. Finds and key listings of more than
+    max_rows rows are not cached but streamed from the wrapped store, so the
+    queries of a collection hold at most maxsize * max_rows rows. Callers get
+    copies of the cached values and may modify them.
+    '''
+    def __init__(self, backend, maxsize=1000, ttl=None, shared_cache=None,
+                 sync_interval=0.1, max_rows=1000):
+        super(CachingDataStore, self).__init__()
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.caches = dict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0,
+                      'shared_hits': 0}
+        self.shared_cache = shared_cache
+        self.sync_interval = sync_interval
+        self.max_rows = max_rows
+        self.last_sync = 0
+        if shared_cache is not None:
+            self.last_invalidation = shared_cache.last_invalidation()
+        for topic in ('afterSave', 'afterRemove'):
+            backend.subsribe(topic, self._invalidate_instance)
+        for topic in ('afterSaveMany', 'afterRemoveMany'):
+            backend.subsribe(topic, self._invalidate_instances)
+        backend.subsribe('afterDelete', self._invalidate_collection)
+
+    ## Cache management ##
+
+    def _get_cache(self, name, kind):
+        '''
+        Returns the local cache of a collection for a kind of entries:
+        `objects` by pk or `queries` by params
+        '''
+        namespace = '%s:%s' % (name, kind)
+        if namespace not in self.caches:
+            self.caches[namespace] = LRUCache(self.maxsize, self.ttl)
+        return self.caches[namespace]
+
+    def _sync(self):
+        '''
+        Applies the invalidations other processes logged in the shared cache
+        '''
+        if self.shared_cache is None:
+            return
+        now = time.time()
+        if now - self.last_sync < self.sync_interval:
+            return
+        self.last_sync = now
+        rows = self.shared_cache.invalidations_since(self.last_invalidation)
+        if not rows:
+            return
+        self.last_invalidation = rows[-1][0]
+        #entries are only dropped so the rows can be applied per namespace,
+        #a None key drops the whole namespace
+        invalidated = dict()
+        for invalidation_id, namespace, key in rows:
+            invalidated.setdefault(namespace, set()).add(key)
+        for namespace, keys in invalidated.items():
+            cache = self.caches.get(namespace)
+            if cache is None:
+                continue
+            if None in keys:
+                cache.clear()
+                continue
+            for cached_key in list(cache.entries.keys()):
+                if self.shared_cache.encode_key(cached_key) in keys:
+                    cache.pop(cached_key)
+
+    def _lookup(self, collection, kind, key):
+        '''
+        Returns the value cached locally or in the shared cache, NotFound on
+        a miss
+        '''
+        self._sync()
+        cache = self._get_cache(collection.name, kind)
+        value = cache.get(key)
+        if value is not NotFound:
+            self.stats['hits'] += 1
+            return value
+        if self.shared_cache is not None:
+            value = self.shared_cache.get('%s:%s' % (collection.name, kind),
+                                          key)
+            if value is not NotFound:
+                self.stats['shared_hits'] += 1
+                cache.set(key, value)
+                return value
+        self.stats['misses'] += 1
+        return NotFound
+
+    def _store(self, collection, kind, key, value):
+        self._get_cache(collection.name, kind).set(key, value)
+        if self.shared_cache is not None:
+            self.shared_cache.set('%s:%s' % (collection.name, kind), key,
+                                  value)
+
+    def _cached(self, collection, kind, key, fetch):
+        value = self._lookup(collection, kind, key)
+        if value is NotFound:
+            value = fetch()
+            self._store(collection, kind, key, value)
+        return copy.deepcopy(value)
+
+    def _invalidate(self, collection, pks):
+        objects = self._get_cache(collection.name, 'objects')
+        for pk in pks:
+            objects.pop(pk)
+        #any cached query may have included or now include the objects
+        self._get_cache(collection.name, 'queries').clear()
+        self.stats['invalidations'] += 1
+        if self.shared_cache is not None:
+            namespace = '%s:objects' % collection.name
+            invalidations = [(namespace, pk) for pk in pks]
+            invalidations.append(('%s:queries' % collection.name, NotFound))
+            self.shared_cache.invalidate_many(invalidations)
+
+    def _invalidate_instance(self, message):
+        if message.get('batched'):
+            #the batch is invalidated at once by _invalidate_instances
+            return
+        collection = message['collection']
+        pk = collection.get_object_id(message['instance'])
+        self._invalidate(collection, [pk])
+
+    def _invalidate_instances(self, message):
+        collection = message['collection']
+        self._invalidate(collection, [collection.get_object_id(instance)
+                                      for instance in message['instances']])
+
+    def _invalidate_collection(self, message):
+        collection = message['collection']
+        for kind in ('objects', 'queries'):
+            self._get_cache(collection.name, kind).clear()
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate_many(
+                [('%s:%s' % (collection.name, kind), NotFound)
+                 for kind in ('objects', 'queries')])
+        self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['shared_hits']) / \
+            float(lookups) if lookups else 0
+        stats['evictions'] = sum(cache.evictions
+                                 for cache in self.caches.values())
+        return stats
+
+    ## Events are published and subscribed on the wrapped store ##
+
+    def subsribe(self, topic, callback):
+        return self.backend.subsribe(topic, callback)
+
+    def publish(self, topic, message):
+        return self.backend.publish(topic, message)
+
+    ## Writes go straight to the wrapped store ##
+
+    def save(self, collection, instance, key=None):
+        return self.backend.save(collection, instance, key)
+
+    def remove(self, collection, instance):
+        return self.backend.remove(collection, instance)
+
+    def save_many(self, collection, instances, keys=None):
+        return self.backend.save_many(collection, instances, keys)
+
+    def remove_many(self, collection, instances):
+        return self.backend.remove_many(collection, instances)
+
+    def delete(self, collection, params):
+        return self.backend.delete(collection, params)
+
+    ## Reads are served from the cache ##
+
+    def _cached_query(self, collection, fetch, *args, **kwargs):
+        '''
+        Returns the cached result of fetch for the query described by args
+        and kwargs, queries that can't be hashed are not cached
+        '''
+        try:
+            key = freeze((args, kwargs))
+        except TypeError:
+            return fetch()
+        return self._cached(collection, 'queries', key, fetch)
+
+    def _cached_rows(self, collection, fetch, *args, **kwargs):
+        '''
+        Like _cached_query for queries returning rows. Results are only
+        cached up to max_rows rows, past that the rows read ahead are
+        returned followed by the rest, streamed from the wrapped store
+        '''
+        try:
+            key = freeze((args, kwargs))
+        except TypeError:
+            return fetch()
+        results = self._lookup(collection, 'queries', key)
+        if results is NotFound:
+            rows = iter(fetch())
+            results = list(itertools.islice(rows, self.max_rows + 1))
+            if len(results) > self.max_rows:
+                return itertools.chain(results, rows)
+            self._store(collection, 'queries', key, results)
+        return copy.deepcopy(results)
+
+    def get(self, collection, params):
+        params = self._normalize_params(collection, params)
+        if params.keys() == ['pk']:
+            return self._cached(collection, 'objects', params['pk'],
+                lambda: self.backend.get(collection, params))
+        return self._cached_query(collection,
+            lambda: self.backend.get(collection, params), 'get', params)
+
+    def get_many(self, collection, pks):
+        self._sync()
+        objects = self._get_cache(collection.name, 'objects')
+        namespace = '%s:objects' % collection.name
+        results, missing = dict(), list()
+        for pk in pks:
+            result = objects.get(pk)
+            if result is NotFound:
+                missing.append(pk)
+            else:
+                results[pk] = result
+        self.stats['hits'] += len(results)
+        if missing and self.shared_cache is not None:
+            for pk in list(missing):
+                result = self.shared_cache.get(namespace, pk)
+                if result is not NotFound:
+                    missing.remove(pk)
+                    objects.set(pk, result)
+                    results[pk] = result
+                    self.stats['shared_hits'] += 1
+        self.stats['misses'] += len(missing)
+        if missing:
+            fetched = self.backend.get_many(collection, missing)
+            for pk, result in fetched.items():
+                objects.set(pk, result)
+                if self.shared_cache is not None:
+                    self.shared_cache.set(namespace, pk, result)
+            results.update(fetched)
+        return copy.deepcopy(results)
+
+    def find(self, collection, params, **options):
+        return self._cached_rows(collection,
+            lambda: self.backend.find(collection, params, **options),
+            'find', params, **options)
+
+    def all(self, collection):
+        return self.find(collection, {})
+
+    def count(self, collection, params):
+        return self._cached_query(collection,
+            lambda: self.backend.count(collection, params), 'count', params)
+
+    def exists(self, collection, params):
+        return self._cached_query(collection,
+            lambda: self.backend.exists(collection, params), 'exists', params)
+
+    def keys(self, collection, params):
+        return self._cached_rows(collection,
+            lambda: self.backend.keys(collection, params), 'keys', params)
+
+    def get_index_stats(self, collection):
+        return self.backend.get_index_stats(collection)
+
+    def explain(self, collection, params):
+        return self.backend.explain(collection, params)
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+'''
+An in memory data store keeping each field of a collection in a column.
+Integer, float and boolean fields are stored in typed arrays, other fields in
+lists, and objects are only assembled when they are iterated. With NumPy
+installed, lookups on typed columns are evaluated as vectorized masks and
+aggregates are computed on the arrays.
+'''
+from __future__ import absolute_import
+
+import operator
+import sys
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .core import BaseDataStore, LOOKUPS, aggregate_values, split_lookup
+
+
+#states of a column cell
+MISSING = 0
+NULL = 1
+VALUE = 2
+
+VECTOR_LOOKUPS = {
+    'exact': operator.eq,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+
+VECTOR_AGGREGATES = {
+    'sum': lambda values: values.sum(),
+    'min': lambda values: values.min(),
+    'max': lambda values: values.max(),
+    'mean': lambda values: values.mean(),
+}
+
+
+def infer_typecode(value):
+    '''
+    Returns the array typecode able to hold the value, None if it needs an
+    object column
+    '''
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, int) and not isinstance(value, long):
+        return 'l'
+    if isinstance(value, float):
+        return 'd'
+    return None
+
+
+def is_numeric(value):
+    return isinstance(value, (int, long, float)) and \
+        -sys.maxint - 1 <= value <= sys.maxint
+
+
+class Column(object):
+    '''
+    The values of a field for every row along with the state of each cell
+    '''
+    def __init__(self, typecode, length=0):
+        self.typecode = typecode
+        if typecode is None:
+            self.values = [None] * length
+        else:
+            self.values = array(typecode, [0]) * length
+        self.states = bytearray(length)
+
+    def get(self, row):
+        state = self.states[row]
+        if state != VALUE:
+            return None
+        value = self.values[row]
+        if self.typecode == 'b':
+            return bool(value)
+        return value
+
+    def set(self, row, value):
+        if value is None:
+            self.states[row] = NULL
+            return
+        if self.typecode is not None and \
+                infer_typecode(value) != self.typecode:
+            self._to_objects()
+        self.values[row] = value
+        self.states[row] = VALUE
+
+    def clear(self, row):
+        self.states[row] = MISSING
+
+    def append(self):
+        self.values.append(None if self.typecode is None else 0)
+        self.states.append(MISSING)
+
+    def swap_remove(self, row):
+        '''
+        Moves the last cell into the row and drops the last cell
+        '''
+        self.values[row] = self.values[-1]
+        self.states[row] = self.states[-1]
+        self.values.pop()
+        del self.states[-1]
+
+    def _to_objects(self):
+        self.values = [self.get(row) for row in xrange(len(self.states))]
+        self.typecode = None
+
+    def as_array(self):
+        '''
+        Returns a NumPy view of the typed values, valid until the column is
+        next resized
+        '''
+        return numpy.frombuffer(self.values, dtype=self.typecode)
+
+    def states_array(self):
+        return numpy.frombuffer(self.states, dtype=numpy.uint8)
+
+
+class Table(object):
+    '''
+    The rows of a collection, pks are mapped to rows and removed rows are
+    filled with the last row
+    '''
+    def __init__(self):
+        self.pks = list()
+        self.rows = dict()
+        self.columns = dict()
+
+    def __len__(self):
+        return len(self.pks)
+
+    def put(self, pk, obj):
+        row = self.rows.get(pk)
+        if row is None:
+            row = len(self.pks)
+            self.pks.append(pk)
+            self.rows[pk] = row
+            for column in self.columns.values():
+                column.append()
+        else:
+            for field, column in self.columns.items():
+                if field not in obj:
+                    column.clear(row)
+        for field, value in obj.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = Column(infer_typecode(value), len(self.pks))
+                self.columns[field] = column
+            column.set(row, value)
+
+    def remove(self, pk):
+        row = self.rows.pop(pk, None)
+        if row is None:
+            return False
+        last = self.pks.pop()
+        if last != pk:
+            self.pks[row] = last
+            self.rows[last] = row
+        for column in self.columns.values():
+            column.swap_remove(row)
+        return True
+
+    def get_value(self, row, field):
+        if field == 'pk':
+            return self.pks[row]
+        column = self.columns.get(field)
+        if column is None:
+            return None
+        return column.get(row)
+
+    def materialize(self, row, fields=None):
+        if fields is None:
+            columns = self.columns.items()
+        else:
+            columns = [(field, self.columns[field]) for field in fields
+                       if field in self.columns]
+        return dict((field, column.get(row)) for field, column in columns
+                    if column.states[row] != MISSING)
+
+
+class ColumnarMemoryDataStore(BaseDataStore):
+    def __init__(self):
+        super(ColumnarMemoryDataStore, self).__init__()
+        self.tables = dict()
+        self.lock = threading.RLock()
+
+    def _get_table(self, collection):
+        if collection.name not in self.tables:
+            self.tables[collection.name] = Table()
+        return self.tables[collection.name]
+
+    def save(self, collection, instance, key=None):
+        instance = self.execute_hooks('beforeSave',
+            {'instance': instance, 'collection': collection})
+        pk = key or collection.get_object_id(instance)
+        obj = collection.get_serializable(instance)
+        with self.lock:
+            self._get_table(collection).put(pk, obj)
+        return self.execute_hooks('afterSave',
+            {'instance': instance, 'collection': collection})
+
+    def remove(self, collection, instance):
+        instance = self.execute_hooks('beforeRemove',
+            {'instance': instance, 'collection': collection})
+        pk = collection.get_object_id(instance)
+        with self.lock:
+            self._get_table(collection).remove(pk)
+        return self.execute_hooks('afterRemove',
+            {'instance': instance, 'collection': collection})
+
+    def save_many(self, collection, instances, keys=None):
+        instances = self.execute_batch_hooks('beforeSave', collection,
+                                             list(instances))
+        if keys is None:
+            keys = [None] * len(instances)
+        with self.lock:
+            table = self._get_table(collection)
+            for instance, key in zip(instances, keys):
+                pk = key or collection.get_object_id(instance)
+                table.put(pk, collection.get_serializable(instance))
+        return self.execute_batch_hooks('afterSave', collection, instances)
+
+    def remove_many(self, collection, instances):
+        instances = self.execute_batch_hooks('beforeRemove', collection,
+                                             list(instances))
+        with self.lock:
+            table = self._get_table(collection)
+            for instance in instances:
+                table.remove(collection.get_object_id(instance))
+        return self.execute_batch_hooks('afterRemove', collection, instances)
+
+    def _filter_rows(self, table, rows, params):
+        params = [split_lookup(param) + (value,)
+                  for param, value in params.items()]
+        return [row for row in rows
+                if all(LOOKUPS[lookup](table.get_value(row, field), value)
+                       for field, lookup, value in params)]
+
+    def _column_mask(self, table, field, lookup, value):
+        '''
+        Returns a boolean array of the rows matching a lookup
+        '''
+        if field == 'pk':
+            return numpy.array([LOOKUPS[lookup](pk, value)
+                                for pk in table.pks], dtype=bool)
+        column = table.columns.get(field)
+        #missing and null cells compare like obj.get(field) does
+        missing = LOOKUPS[lookup](None, value)
+        if column is None:
+            return numpy.repeat(missing, len(table))
+        values = value if lookup == 'in' else [value]
+        if column.typecode is None or \
+                not all(is_numeric(item) for item in values):
+            return numpy.array([LOOKUPS[lookup](column.get(row), value)
+                                for row in xrange(len(table))], dtype=bool)
+        cells = column.as_array()
+        if lookup == 'in':
+            matched = numpy.in1d(cells, list(value))
+        else:
+            matched = VECTOR_LOOKUPS[lookup](cells, value)
+        return numpy.where(column.states_array() == VALUE, matched, missing)
+
+    def _find_rows(self, table, params):
+        '''
+        Returns the rows matching the normalized params, in row order
+        '''
+        params = dict(params)
+        if 'pk' in params or 'pk__in' in params:
+            if 'pk' in params:
+                pks = [params.pop('pk')]
+            else:
+                pks = params.pop('pk__in')
+            rows = sorted(set(table.rows[pk] for pk in pks
+                              if pk in table.rows))
+            return self._filter_rows(table, rows, params)
+        if numpy is None or not params or not len(table):
+            return self._filter_rows(table, xrange(len(table)), params)
+        mask = numpy.ones(len(table), dtype=bool)
+        for param, value in params.items():
+            field, lookup = split_lookup(param)
+            mask &= self._column_mask(table, field, lookup, value)
+        return numpy.flatnonzero(mask).tolist()
+
+    def _iter_objects(self, table, pks, fields=None):
+        #rows move when others are removed, so look them up as we go
+        for pk in pks:
+            with self.lock:
+                row = table.rows.get(pk)
+                if row is not None:
+                    obj = table.materialize(row, fields)
+            if row is not None:
+                yield obj
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            rows = self._find_rows(table, params)
+            if order_by:
+                order_by = self._normalize_ordering(collection, order_by)
+                rows = self._order_results(rows, order_by, table.get_value)
+            rows = list(self._apply_window(rows, limit, offset))
+            pks = [table.pks[row] for row in rows]
+            fields = None
+            if only:
+                fields = set(only)
+                fields.add(collection.object_id_field)
+            if defer:
+                fields = set(fields or table.columns.keys())
+                fields.difference_update(set(defer) -
+                                         set([collection.object_id_field]))
+        return self._iter_objects(table, pks, fields)
+
+    def get(self, collection, params):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            if 'pk' in params and len(params) == 1:
+                return table.materialize(table.rows[params['pk']])
+            for row in self._find_rows(table, params):
+                return table.materialize(row)
+        raise KeyError('Not found: %s' % params)
+
+    def get_many(self, collection, pks):
+        with self.lock:
+            table = self._get_table(collection)
+            return dict((pk, table.materialize(table.rows[pk]))
+                        for pk in pks if pk in table.rows)
+
+    def count(self, collection, params):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            if not params:
+                return len(table)
+            return len(self._find_rows(table, params))
+
+    def exists(self, collection, params):
+        return bool(self.count(collection, params))
+
+    def keys(self, collection, params):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            if not params:
+                return list(table.pks)
+            return [table.pks[row] for row in self._find_rows(table, params)]
+
+    def delete(self, collection, params):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            if not params:
+                deleted = len(table)
+                self.tables[collection.name] = Table()
+            else:
+                pks = [table.pks[row]
+                       for row in self._find_rows(table, params)]
+                for pk in pks:
+                    table.remove(pk)
+                deleted = len(pks)
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return deleted
+
+    def _aggregate_rows(self, table, rows, func, field):
+        if field == 'pk' or field not in table.columns:
+            if func == 'count' and field == 'pk':
+                return len(rows)
+            values = [table.get_value(row, field) for row in rows]
+            return aggregate_values(func, [value for value in values
+                                           if value is not None])
+        column = table.columns[field]
+        if numpy is not None and column.typecode is not None and rows:
+            if func not in VECTOR_AGGREGATES and func != 'count':
+                raise ValueError('Unknown aggregate: %s' % func)
+            present = column.states_array()[rows] == VALUE
+            values = column.as_array()[rows][present]
+            if func == 'count':
+                return len(values)
+            if not len(values):
+                return aggregate_values(func, [])
+            return VECTOR_AGGREGATES[func](values).item()
+        values = [column.get(row) for row in rows
+                  if column.states[row] == VALUE]
+        return aggregate_values(func, values)
+
+    def aggregate(self, collection, params, aggregations, group_by=()):
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            table = self._get_table(collection)
+            rows = self._find_rows(table, params)
+            if not group_by:
+                return dict((name, self._aggregate_rows(table, rows, func,
+                                                        field))
+                            for name, (func, field) in aggregations.items())
+            groups = dict()
+            for row in rows:
+                key = tuple(table.get_value(row, field) for field in group_by)
+                groups.setdefault(key, list()).append(row)
+            results = list()
+            for key in sorted(groups.keys()):
+                result = dict(zip(group_by, key))
+                for name, (func, field) in aggregations.items():
+                    result[name] = self._aggregate_rows(table, groups[key],
+                                                        func, field)
+                results.append(result)
+            return results
@@ -1,11 +1,171 @@
 # -*- coding: utf-8 -*-
+import itertools
+import operator
 
 
 class UnsupportedOperation(Exception):
     pass
 
 
+#lookup suffix => comparison of (stored value, query value)
+LOOKUPS = {
+    'exact': operator.eq,
+    'in': lambda value, values: value in values,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+
+RANGE_LOOKUPS = ('lt', 'lte', 'gt', 'gte')
+
+#aggregate function => reduction of the non null values
+AGGREGATES = {
+    'count': len,
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'mean': lambda values: float(sum(values)) / len(values),
+}
+
+
+def aggregate_values(func, values):
+    '''
+    Applies the named aggregate to the values, min, max and mean of no
+    values are None
+    '''
+    if func not in AGGREGATES:
+        raise ValueError('Unknown aggregate: %s' % func)
+    if not values and func not in ('count', 'sum'):
+        return None
+    return AGGREGATES[func](values)
+
+
+def split_lookup(param):
+    '''
+    Splits a query param into its field and lookup type:
+    `created__gte` => ('created', 'gte'), `status` => ('status', 'exact')
+    '''
+    field, sep, lookup = param.rpartition('__')
+    if sep and lookup in LOOKUPS:
+        return field, lookup
+    return param, 'exact'
+
+
+class IndexStats(object):
+    '''
+    Cardinality statistics of a secondary index used to estimate selectivity
+    '''
+    def __init__(self, cardinality, size, counter=None):
+        self.cardinality = cardinality  # number of distinct values
+        self.size = size  # number of indexed entries
+        # optional callable(lookup, value) returning exact match counts
+        self.counter = counter
+
+    def estimate(self, lookup='exact', value=None):
+        '''
+        Returns the estimated number of matching entries or None if the index
+        can't answer the lookup
+        '''
+        if self.counter is not None:
+            return self.counter(lookup, value)
+        if lookup not in ('exact', 'in'):
+            return None
+        if not self.cardinality:
+            return 0
+        value_count = len(value) if lookup == 'in' else 1
+        return value_count * self.size / float(self.cardinality)
+
+
+class PlanStep(object):
+    def __init__(self, operation, param, estimate=None):
+        self.operation = operation
+        self.param = param
+        self.estimate = estimate
+
+    def __repr__(self):
+        if self.estimate is None:
+            return '%s %s' % (self.operation, self.param)
+        return '%s %s (est. %d rows)' % (self.operation, self.param,
+                                         self.estimate)
+
+
+class QueryPlan(object):
+    '''
+    The ordered steps a data store takes to answer a query:
+
+    * probe: fetch the candidate pks from the index for the param
+    * intersect: narrow the candidates with another index
+    * filter: compare the param against each candidate
+    * scan: no index applies, every object is a candidate
+    '''
+    def __init__(self, steps, estimate):
+        self.steps = steps
+        self.estimate = estimate
+
+    def index_steps(self):
+        return [step for step in self.steps
+                if step.operation in ('probe', 'intersect')]
+
+    def __repr__(self):
+        lines = [repr(step) for step in self.steps]
+        lines.append('=> est. %d rows' % self.estimate)
+        return '\n'.join(lines)
+
+
+class QueryPlanner(object):
+    '''
+    Orders the lookups of a query by the estimated number of matching rows
+    using the index statistics reported by the data store
+    '''
+    def __init__(self, data_store):
+        self.data_store = data_store
+
+    def estimate(self, stats, param, value):
+        field, lookup = split_lookup(param)
+        if field == 'pk':
+            if lookup == 'exact':
+                return 1
+            if lookup == 'in':
+                return len(value)
+        elif field in stats:
+            return stats[field].estimate(lookup, value)
+        return None
+
+    def plan(self, collection, params):
+        stats = self.data_store.get_index_stats(collection)
+        total = self.data_store.count(collection, {})
+        indexed, filters = list(), list()
+        for param, value in params.items():
+            estimate = self.estimate(stats, param, value)
+            if estimate is None:
+                filters.append(PlanStep('filter', param))
+            else:
+                indexed.append(PlanStep('probe', param, estimate))
+        indexed.sort(key=lambda step: step.estimate)
+
+        if not indexed:
+            steps = [PlanStep('scan', collection.name, total)]
+            estimate = total
+        else:
+            steps = [indexed[0]]
+            estimate = indexed[0].estimate
+            for step in indexed[1:]:
+                #an index only pays off if it is smaller than what we have
+                if step.estimate < estimate:
+                    step.operation = 'intersect'
+                    steps.append(step)
+                    if total:
+                        estimate = estimate * step.estimate / float(total)
+                else:
+                    filters.append(PlanStep('filter', step.param))
+        steps.extend(filters)
+        return QueryPlan(steps, estimate)
+
+
 class BaseDataStore(object):
+    planner_class = QueryPlanner
+
     def __init__(self):
         self.subscribers = dict()
 
@@ -16,6 +176,8 @@ class BaseDataStore(object):
         subscribers = self.subscribers.get(topic)
         if not subscribers:
             return
+        #copied so the hook kwargs the message was built from are untouched
+        message = dict(message)
         message["topic"] = topic
         #stubs
         message["action_id"] = None #TODO uuid, useful for versioning
@@ -27,6 +189,26 @@ class BaseDataStore(object):
         self.publish(hook, kwargs)
         return getattr(kwargs.pop('collection'), hook)(**kwargs)
 
+    def execute_batch_hooks(self, hook, collection, instances):
+        '''
+        Publishes a single `<hook>Many` message for the batch and runs the
+        collection hook on each instance. Subscribers of the per instance
+        topic are still notified for each instance, the messages are flagged
+        `batched` so subscribers of both topics can skip them.
+        '''
+        self.publish('%sMany' % hook,
+            {'instances': instances, 'collection': collection})
+        notify = bool(self.subscribers.get(hook))
+        collection_hook = getattr(collection, hook)
+        results = list()
+        for instance in instances:
+            if notify:
+                self.publish(hook, {'instance': instance,
+                                    'collection': collection,
+                                    'batched': True})
+            results.append(collection_hook(instance=instance))
+        return results
+
     def load_instance(self, collection, result):
         instance = collection.get_loader()(**result)
         return self.execute_hooks('afterInitialize',
@@ -38,33 +220,172 @@ class BaseDataStore(object):
     def remove(self, collection, instance):
         raise UnsupportedOperation
 
+    def save_many(self, collection, instances, keys=None):
+        '''
+        Saves a batch of instances, keys optionally lists the key of each
+        '''
+        if keys is None:
+            keys = [None] * len(instances)
+        return [self.save(collection, instance, key)
+                for instance, key in zip(instances, keys)]
+
+    def remove_many(self, collection, instances):
+        return [self.remove(collection, instance) for instance in instances]
+
     def _normalize_params(self, collection, params):
         id_field = collection.object_id_field
         if id_field:
             params = dict(params)
-            if id_field in params:
-                params['pk'] = params.pop(id_field)
-            if '%s__in' % id_field in params:
-                params['pk__in'] = params.pop('%s__in' % id_field)
+            for param in list(params.keys()):
+                field, lookup = split_lookup(param)
+                if field != id_field:
+                    continue
+                if lookup == 'exact':
+                    params['pk'] = params.pop(param)
+                else:
+                    params['pk__%s' % lookup] = params.pop(param)
         return params
 
+    def _normalize_ordering(self, collection, order_by):
+        '''
+        Maps the object id field of an ordering to `pk`
+        '''
+        ordering = list()
+        for field in order_by:
+            prefix = '-' if field.startswith('-') else ''
+            if field.lstrip('-') == collection.object_id_field:
+                field = prefix + 'pk'
+            ordering.append(field)
+        return ordering
+
+    def _apply_window(self, results, limit=None, offset=None):
+        '''
+        Lazily skips offset results and stops after limit results
+        '''
+        if not offset and limit is None:
+            return results
+        stop = None if limit is None else (offset or 0) + limit
+        return itertools.islice(results, offset or 0, stop)
+
+    def _project(self, collection, result, only=None, defer=None):
+        '''
+        Returns a copy of the result restricted to the only fields, minus the
+        deferred ones. The object id field is always kept.
+        '''
+        id_field = collection.object_id_field
+        if only:
+            fields = set(only)
+            fields.add(id_field)
+            result = dict((key, value) for key, value in result.items()
+                          if key in fields)
+        if defer:
+            result = dict((key, value) for key, value in result.items()
+                          if key not in defer or key == id_field)
+        return result
+
+    def _project_results(self, collection, results, only=None, defer=None):
+        if not only and not defer:
+            return results
+        return (self._project(collection, result, only, defer)
+                for result in results)
+
+    def _order_results(self, results, order_by,
+                       getter=lambda obj, field: obj.get(field)):
+        '''
+        Sorts the results in python, `-` prefixed fields sort descending
+        '''
+        results = list(results)
+        for field in reversed(order_by):
+            reverse = field.startswith('-')
+            field = field.lstrip('-')
+            results.sort(key=lambda obj: getter(obj, field), reverse=reverse)
+        return results
+
+    def get_index_stats(self, collection):
+        '''
+        Returns a dictionary of field => IndexStats for the indexes the data
+        store maintains for the collection
+        '''
+        return dict()
+
+    def explain(self, collection, params):
+        params = self._normalize_params(collection, params)
+        return self.planner_class(self).plan(collection, params)
+
     def get(self, collection, params):
         raise UnsupportedOperation
 
-    def find(self, collection, params):
+    def get_many(self, collection, pks):
+        '''
+        Returns a dictionary of pk => result for the pks that exist
+        '''
+        results = dict()
+        for pk in pks:
+            try:
+                results[pk] = self.get(collection, {'pk': pk})
+            except (KeyError, IndexError):
+                pass
+        return results
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        '''
+        parallel holds the executor, chunk_size and ordered options of
+        CollectionQuery.parallel, stores that can't split the evaluation of
+        a find ignore it
+        '''
         raise UnsupportedOperation
 
     def all(self, collection):
         return self.find(collection, {})
 
+    def aggregate(self, collection, params, aggregations, group_by=()):
+        '''
+        Computes aggregations, a dictionary of name => (function, field), over
+        the matching objects. Counting the `pk` field counts the objects,
+        other aggregates skip missing and null values. Returns a dictionary
+        of name => value, or with group_by a list of such dictionaries also
+        holding the group_by fields, ordered by them.
+        '''
+        id_field = collection.object_id_field
+        fields = set(group_by)
+        fields.update(field for func, field in aggregations.values())
+        fields.discard('pk')
+        groups = dict()
+        for result in self.find(collection, params, only=list(fields)):
+            key = tuple(result.get(field) for field in group_by)
+            group = groups.setdefault(key, dict((name, list())
+                                                for name in aggregations))
+            for name, (func, field) in aggregations.items():
+                if field == 'pk':
+                    field = id_field
+                value = result.get(field)
+                if value is not None:
+                    group[name].append(value)
+        if not group_by:
+            group = groups.get((), dict((name, list())
+                                        for name in aggregations))
+            return dict((name, aggregate_values(aggregations[name][0], values))
+                        for name, values in group.items())
+        results = list()
+        for key in sorted(groups.keys()):
+            result = dict(zip(group_by, key))
+            for name, values in groups[key].items():
+                result[name] = aggregate_values(aggregations[name][0], values)
+            results.append(result)
+        return results
+
     def delete(self, collection, params):
         raise UnsupportedOperation
 
     def exists(self, collection, params):
-        return bool(self.count(collection, params))
+        for instance in self.find(collection, params, limit=1):
+            return True
+        return False
 
     def count(self, collection, params):
-        return len(self.find(collection, params))
+        #find may return a generator, so count without materializing it
+        return sum(1 for instance in self.find(collection, params))
 
     def keys(self, collection, params):
         for instance in self.find(collection, params):
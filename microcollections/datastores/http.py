@@ -1,19 +1,166 @@
 # -*- coding: utf-8 -*-
+import Queue
+import copy
+import itertools
+import random
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
 import requests
-import json
+from requests.adapters import HTTPAdapter
 
+from microcollections.codecs import get_codec
+from .caching import LRUCache
 from .core import BaseDataStore, UnsupportedOperation
 
 
+NotFound = object()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Stops sending requests after failure_threshold consecutive failures,
+    letting a single trial request through every reset_timeout seconds until
+    one succeeds
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_request(self):
+        with self.lock:
+            state = self.state
+            if state == 'open':
+                raise CircuitOpenError('Circuit open after %s failures' %
+                                       self.failures)
+            if state == 'half-open':
+                #only one trial request until it resolves
+                self.opened_at = time.time()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
 class HTTPDataStore(BaseDataStore):
     '''
     A DataStore that connects to a RESTful web service
     '''
-    def __init__(self, url, session=None):
+    #query string parameters used to request an ordering and a window
+    order_by_param = 'ordering'
+    limit_param = 'limit'
+    offset_param = 'offset'
+    #query string parameters used to request a projection, deferred fields
+    #are dropped client side when the service has no defer_param
+    fields_param = 'fields'
+    defer_param = None
+    #query string parameters and response keys used by the pagination modes
+    page_param = 'page'
+    page_size_param = 'page_size'
+    cursor_param = 'cursor'
+    #query string parameter listing the pks to fetch from the batch_url
+    batch_pks_param = 'ids'
+    results_key = 'results'
+    next_key = 'next'
+    #response header a HEAD request on the index reports the match count in
+    total_count_header = 'X-Total-Count'
+    #verbs that are safe to retry and statuses that trigger a retry
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+    retry_statuses = (429, 502, 503, 504)
+    max_backoff = 30
+
+    def __init__(self, url, session=None, pagination=None, page_size=100,
+                 prefetch=False, batch_url=None, batch_size=100, codec=None,
+                 max_workers=8, pool_size=10, timeout=None, retries=0,
+                 backoff=0.1, circuit_breaker=None, compress_min_size=None,
+                 conditional_cache_size=1000, stream=False,
+                 chunk_size=64 * 1024):
+        '''
+        pagination may be one of:
+
+        * None: the index returns every result in one response
+        * 'page': request numbered pages of page_size results
+        * 'offset': request page_size results at increasing offsets
+        * 'cursor': follow the next link of each page, from the `Link`
+          header or the `next` key of the response
+
+        When batch_url is set, save_many POSTs lists of up to batch_size
+        serialized objects to it, remove_many sends it a DELETE with the
+        list of pks and get_many GETs it with the pks. Without it get_many
+        fetches each object with up to max_workers concurrent requests.
+
+        codec names the registered codec payloads are encoded with, the
+        fastest installed JSON codec by default.
+
+        A session created by the store keeps up to pool_size connections
+        alive per host. Requests time out after timeout seconds (or a
+        (connect, read) tuple), idempotent requests are retried up to retries
+        times with jittered exponential backoff starting at backoff seconds,
+        and an optional CircuitBreaker fails requests fast while the service
+        is down. Request bodies of at least compress_min_size bytes are sent
+        gzipped.
+
+        get remembers the ETag and Last-Modified validators of up to
+        conditional_cache_size objects and revalidates them with a
+        conditional request, a 304 is answered from the cached copy. Pass
+        None to disable.
+
+        With stream, listings that aren't paginated are decoded incrementally
+        from chunk_size reads of the response, yielding each result as soon
+        as it has arrived.
+        '''
+        assert pagination in (None, 'page', 'offset', 'cursor')
         self.url = url
         if session is None:
             session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
         self.session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.circuit_breaker = circuit_breaker
+        self.compress_min_size = compress_min_size
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.conditional_cache = None
+        if conditional_cache_size:
+            self.conditional_cache = LRUCache(conditional_cache_size)
+        self.pagination = pagination
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.batch_url = batch_url
+        self.batch_size = batch_size
+        self.codec = get_codec(codec)
+        self.max_workers = max_workers
         super(HTTPDataStore, self).__init__()
 
     def get_object_lookup(self, collection, instance):
@@ -31,11 +178,115 @@ class HTTPDataStore(BaseDataStore):
     def get_add_url(self):
         return self.url
 
+    def compress_body(self, data, headers):
+        if self.compress_min_size is None or \
+                len(data) < self.compress_min_size:
+            return data
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        headers['Content-Encoding'] = 'gzip'
+        return compressor.compress(data) + compressor.flush()
+
+    def get_retry_delay(self, attempt):
+        '''
+        Returns a random delay of up to backoff * 2 ** attempt seconds
+        '''
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        '''
+        Sends a request through the session applying the timeout, codec
+        content type, body compression, retry and circuit breaker policies
+        '''
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        headers = dict(kwargs.get('headers') or {})
+        headers.setdefault('Accept', self.codec.content_type)
+        if kwargs.get('data') is not None:
+            headers.setdefault('Content-Type', self.codec.content_type)
+            kwargs['data'] = self.compress_body(kwargs['data'], headers)
+        kwargs['headers'] = headers
+        retries = self.retries if method in self.idempotent_methods else 0
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure()
+                if attempt >= retries:
+                    raise
+            else:
+                failed = response.status_code >= 500 or \
+                    response.status_code in self.retry_statuses
+                if self.circuit_breaker is not None:
+                    if failed:
+                        self.circuit_breaker.record_failure()
+                    else:
+                        self.circuit_breaker.record_success()
+                if response.status_code not in self.retry_statuses or \
+                        attempt >= retries:
+                    return response
+                #release the connection of the discarded response
+                response.close()
+            time.sleep(self.get_retry_delay(attempt))
+            attempt += 1
+
+    def get_conditional_headers(self, url):
+        '''
+        Returns the validators cached for the url as request headers along
+        with the cached object
+        '''
+        if self.conditional_cache is None:
+            return dict(), None
+        cached = self.conditional_cache.get(url, None)
+        if cached is None:
+            return dict(), None
+        return dict(cached[0]), cached[1]
+
+    def cache_response(self, url, response, result):
+        if self.conditional_cache is None:
+            return
+        headers = dict()
+        if response.headers.get('ETag'):
+            headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        if headers:
+            self.conditional_cache.set(url, (headers, copy.deepcopy(result)))
+        else:
+            self.conditional_cache.pop(url)
+
+    def forget_object(self, pk):
+        if self.conditional_cache is not None:
+            self.conditional_cache.pop(self.get_object_url(pk))
+
     def serialize_data(self, data):
-        return json.dumps(data)
+        return self.codec.dumps(data)
 
     def deserialize_response(self, response):
-        return response.json()
+        return self.codec.loads(response.content)
+
+    def iter_response_results(self, response):
+        '''
+        Yields the results of a streamed listing as they are decoded, the
+        listing may be an array or an object holding it under results_key
+        '''
+        try:
+            chunks = response.iter_content(self.chunk_size)
+            first = next(chunks, '')
+            key = None
+            #binary codecs can't be sniffed like JSON text
+            if self.codec.content_type == 'application/json' and \
+                    first.lstrip()[:1] == '{':
+                key = self.results_key
+            chunks = itertools.chain([first], chunks)
+            for result in self.codec.iterdecode(chunks, key):
+                yield result
+        finally:
+            response.close()
 
     def save(self, collection, instance, key=None):
         instance = self.execute_hooks('beforeSave',
@@ -43,9 +294,10 @@ class HTTPDataStore(BaseDataStore):
         pk = key or self.get_object_lookup(collection, instance)
         payload = self.serialize_data(collection.get_serializable(instance))
         if pk:
-            self.session.put(self.get_object_url(pk), data=payload)
+            self.forget_object(pk)
+            self.request('PUT', self.get_object_url(pk), data=payload)
         else:
-            self.session.post(self.get_add_url(), data=payload)
+            self.request('POST', self.get_add_url(), data=payload)
         return self.execute_hooks('afterSave',
             {'instance': instance, 'collection': collection})
 
@@ -53,18 +305,277 @@ class HTTPDataStore(BaseDataStore):
         instance = self.execute_hooks('beforeRemove',
             {'instance': instance, 'collection': collection})
         pk = self.get_object_lookup(collection, instance)
-        self.session.delete(self.get_object_lookup(pk))
+        self.forget_object(pk)
+        self.request('DELETE', self.get_object_url(pk))
         return self.execute_hooks('afterRemove',
             {'instance': instance, 'collection': collection})
 
+    def _iter_batches(self, items):
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    def save_many(self, collection, instances, keys=None):
+        if not self.batch_url:
+            return super(HTTPDataStore, self).save_many(collection,
+                                                        instances, keys)
+        instances = self.execute_batch_hooks('beforeSave', collection,
+                                             list(instances))
+        payload = [collection.get_serializable(instance)
+                   for instance in instances]
+        id_field = collection.object_id_field
+        for obj in payload:
+            if obj.get(id_field):
+                self.forget_object(obj[id_field])
+        for batch in self._iter_batches(payload):
+            self.request('POST', self.batch_url,
+                         data=self.serialize_data(batch))
+        return self.execute_batch_hooks('afterSave', collection, instances)
+
+    def remove_many(self, collection, instances):
+        if not self.batch_url:
+            return super(HTTPDataStore, self).remove_many(collection,
+                                                          instances)
+        instances = self.execute_batch_hooks('beforeRemove', collection,
+                                             list(instances))
+        pks = [self.get_object_lookup(collection, instance)
+               for instance in instances]
+        for pk in pks:
+            self.forget_object(pk)
+        for batch in self._iter_batches(pks):
+            self.request('DELETE', self.batch_url,
+                         data=self.serialize_data(batch))
+        return self.execute_batch_hooks('afterRemove', collection, instances)
+
     def get(self, collection, params):
         params = self._normalize_params(collection, params)
         if 'pk' in params:
-            response = self.session.get(self.get_object_url(params['pk']))
-            return self.deserialize_response(response)
+            url = self.get_object_url(params['pk'])
+            headers, cached = self.get_conditional_headers(url)
+            response = self.request('GET', url, headers=headers)
+            if response.status_code == 304 and cached is not None:
+                return copy.deepcopy(cached)
+            if response.status_code == 404:
+                self.forget_object(params['pk'])
+                raise KeyError('Not found: %s' % params['pk'])
+            result = self.deserialize_response(response)
+            self.cache_response(url, response, result)
+            return result
         raise UnsupportedOperation('Lookups must be by pk')
 
-    def find(self, collection, params):
+    def get_many(self, collection, pks):
+        pks = list(pks)
+        if self.batch_url:
+            results = dict()
+            id_field = collection.object_id_field
+            for batch in self._iter_batches(pks):
+                params = {self.batch_pks_param: ','.join(map(str, batch))}
+                response = self.request('GET', self.batch_url, params=params)
+                for result in self.deserialize_response(response):
+                    results[result[id_field]] = result
+            return results
+        if len(pks) < 2 or self.max_workers < 2:
+            return super(HTTPDataStore, self).get_many(collection, pks)
+
+        def fetch(pk):
+            try:
+                return pk, self.get(collection, {'pk': pk})
+            except KeyError:
+                return pk, NotFound
+
+        pool = ThreadPool(min(self.max_workers, len(pks)))
+        try:
+            return dict((pk, result) for pk, result in pool.map(fetch, pks)
+                        if result is not NotFound)
+        finally:
+            pool.close()
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
         #TODO invert params = self._normalize_params(collection, params)
-        response = self.session.get(self.get_index_url(), params=params)
-        return self.deserialize_response(response)
+        normalized = self._normalize_params(collection, params)
+        if normalized.keys() == ['pk__in'] and not (order_by or only or
+                                                    defer):
+            results = self.get_many(collection, normalized['pk__in'])
+            results = [results[pk] for pk in normalized['pk__in']
+                       if pk in results]
+            return self._apply_window(results, limit, offset)
+        params = dict(params)
+        if order_by:
+            params[self.order_by_param] = ','.join(order_by)
+        if only:
+            fields = list(only)
+            if collection.object_id_field not in fields:
+                fields.append(collection.object_id_field)
+            params[self.fields_param] = ','.join(fields)
+        if defer and self.defer_param:
+            params[self.defer_param] = ','.join(defer)
+            defer = None
+        if self.pagination:
+            pages = self._iter_pages(params, limit, offset)
+            if self.prefetch:
+                pages = self._prefetch_pages(pages)
+            results = self._iter_page_results(pages)
+        else:
+            if limit is not None:
+                params[self.limit_param] = limit
+            if offset:
+                params[self.offset_param] = offset
+            if self.stream:
+                response = self.request('GET', self.get_index_url(),
+                                        params=params, stream=True)
+                results = self.iter_response_results(response)
+            else:
+                response = self.request('GET', self.get_index_url(),
+                                        params=params)
+                results = self.deserialize_response(response)
+        return self._project_results(collection, results, defer=defer)
+
+    def count(self, collection, params):
+        '''
+        Asks the index for the number of matches with a HEAD request, falling
+        back to counting the streamed results when the service doesn't send
+        the total count header
+        '''
+        normalized = self._normalize_params(collection, params)
+        if 'pk__in' not in normalized:
+            response = self.request('HEAD', self.get_index_url(),
+                                    params=dict(params))
+            total = response.headers.get(self.total_count_header)
+            if response.status_code < 300 and total is not None:
+                return int(total)
+        return sum(1 for result in self.find(collection, params))
+
+    def exists(self, collection, params):
+        normalized = self._normalize_params(collection, params)
+        if normalized.keys() == ['pk']:
+            response = self.request('HEAD',
+                                    self.get_object_url(normalized['pk']))
+            if response.status_code == 404:
+                return False
+            if response.status_code < 300:
+                return True
+        for result in self.find(collection, params, limit=1):
+            return True
+        return False
+
+    def keys(self, collection, params):
+        id_field = collection.object_id_field
+        results = self.find(collection, params, only=[id_field])
+        return [result[id_field] for result in results]
+
+    def get_page_results(self, body):
+        '''
+        Returns the list of results from a deserialized page
+        '''
+        if isinstance(body, dict):
+            return body.get(self.results_key) or []
+        return body
+
+    def get_next_page(self, response, body):
+        '''
+        Returns the url or cursor of the next page or None for the last page
+        '''
+        next_link = response.links.get('next')
+        if next_link:
+            return next_link['url']
+        if isinstance(body, dict):
+            return body.get(self.next_key)
+        return None
+
+    def _iter_pages(self, params, limit=None, offset=None):
+        '''
+        Yields lists of results one page at a time, stopping once limit
+        results past offset have been returned
+        '''
+        page_size = self.page_size
+        remaining = limit
+        skip = offset or 0
+        url = self.get_index_url()
+        params = dict(params)
+        if self.pagination == 'page':
+            params[self.page_param] = skip // page_size + 1
+            params[self.page_size_param] = page_size
+            skip = skip % page_size
+        elif self.pagination == 'offset':
+            params[self.offset_param] = skip
+            skip = 0
+        else:
+            params[self.page_size_param] = page_size
+
+        while remaining is None or remaining > 0:
+            if self.pagination == 'offset':
+                params[self.limit_param] = page_size \
+                    if remaining is None else min(page_size, remaining)
+            response = self.request('GET', url, params=params)
+            body = self.deserialize_response(response)
+            results = self.get_page_results(body)
+            full_page = len(results) >= page_size
+            if skip:
+                skip, results = max(0, skip - len(results)), results[skip:]
+            if remaining is not None:
+                results = results[:remaining]
+                remaining -= len(results)
+            if results:
+                yield results
+
+            if self.pagination == 'cursor':
+                next_page = self.get_next_page(response, body)
+                if not next_page:
+                    return
+                if '://' in next_page or next_page.startswith('/'):
+                    url, params = next_page, None
+                else:
+                    params = dict(params or {})
+                    params[self.cursor_param] = next_page
+            elif not full_page:
+                return
+            elif self.pagination == 'page':
+                params[self.page_param] += 1
+            else:
+                params[self.offset_param] += page_size
+
+    def _prefetch_pages(self, pages):
+        '''
+        Fetches the next page in a background thread while the current one is
+        consumed, holding at most one page in reserve
+        '''
+        pending = Queue.Queue(maxsize=1)
+        stopped = threading.Event()
+        last_page = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                except Queue.Full:
+                    continue
+                return True
+            return False
+
+        def worker():
+            try:
+                for page in pages:
+                    if not put((page, None)):
+                        return
+                put((last_page, None))
+            except Exception:
+                put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                page, error = pending.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if page is last_page:
+                    return
+                yield page
+        finally:
+            stopped.set()
+
+    def _iter_page_results(self, pages):
+        for page in pages:
+            for result in page:
+                yield result
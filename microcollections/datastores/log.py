@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+'''
+A data store appending every write to segment files, so sustained writes are
+sequential I/O. Each collection keeps a hash index of pk to the location of
+its latest record and reads objects with a single read of the mapped segment.
+Sealed segments get a hint file listing their keys and record locations, so
+a restart rebuilds the index without reading the objects back, and are merged
+in the background to reclaim the space of overwritten and removed objects.
+'''
+from __future__ import absolute_import
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import MutableMapping, OrderedDict
+
+from microcollections.codecs import get_codec
+from .memory import MemoryDataStore
+
+
+#crc, flag, key length, value length
+RECORD = struct.Struct('>IBII')
+#flag, key length, record offset, record length
+HINT = struct.Struct('>BIII')
+PUT = 1
+TOMBSTONE = 0
+
+
+def hashable(value):
+    '''
+    Returns a decoded key with its arrays as tuples, codecs load tuple pks
+    back as lists
+    '''
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    return value
+
+
+def iter_records(path):
+    '''
+    Yields the (flag, key, offset, record length) of the records in a segment
+    file, stopping at the first incomplete or corrupted record
+    '''
+    offset = 0
+    with open(path, 'rb') as segment:
+        while True:
+            header = segment.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            crc, flag, key_length, value_length = RECORD.unpack(header)
+            body = segment.read(key_length + value_length)
+            if len(body) < key_length + value_length or \
+                    zlib.crc32(chr(flag) + body) & 0xffffffff != crc:
+                return
+            length = RECORD.size + len(body)
+            yield flag, body[:key_length], offset, length
+            offset += length
+
+
+def iter_hints(path):
+    with open(path, 'rb') as hints:
+        while True:
+            header = hints.read(HINT.size)
+            if len(header) < HINT.size:
+                return
+            flag, key_length, offset, length = HINT.unpack(header)
+            yield flag, hints.read(key_length), offset, length
+
+
+class Segment(object):
+    def __init__(self, path, segment_id, merged=False):
+        self.path = path
+        self.id = segment_id
+        self.merged = merged
+        self.size = 0
+        self.map = None
+        self.reader = None
+
+    @property
+    def hint_path(self):
+        return self.path + '.hint'
+
+    def read(self, offset, length):
+        '''
+        Reads from the file while the segment is written to, from a map of
+        it once it is sealed
+        '''
+        if self.reader is not None:
+            self.reader.seek(offset)
+            return self.reader.read(length)
+        if self.map is None:
+            with open(self.path, 'rb') as segment:
+                self.map = mmap.mmap(segment.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def write_hints(self):
+        with open(self.hint_path + '.tmp', 'wb') as hints:
+            for flag, key, offset, length in iter_records(self.path):
+                hints.write(HINT.pack(flag, len(key), offset, length) + key)
+            hints.flush()
+            os.fsync(hints.fileno())
+        os.rename(self.hint_path + '.tmp', self.hint_path)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+class SegmentLog(MutableMapping):
+    '''
+    A mapping of pk to object persisted as a log of segment files in a
+    directory. Records older than the latest of their pk are dead weight
+    until compact merges the sealed segments.
+    '''
+    def __init__(self, directory, codec, segment_size, compact_ratio=None,
+                 sync=False):
+        self.directory = directory
+        self.codec = codec
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.sync = sync
+        #pk => (segment id, record offset, record length, key length)
+        self.index = dict()
+        self.segments = OrderedDict()
+        self.total_bytes = 0
+        #segment id => bytes of the records the index points to
+        self.live_bytes = dict()
+        self.compacting = False
+        #the background thread started by the last write to need compaction
+        self.compactor = None
+        self.lock = threading.RLock()
+        self.writer = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _segment_path(self, segment_id, merged=False):
+        extension = 'merged' if merged else 'log'
+        return os.path.join(self.directory,
+                            '%010d.%s' % (segment_id, extension))
+
+    def _load(self):
+        '''
+        Rebuilds the index from the latest merged segment and the segments
+        written after it, reading hint files where they exist
+        '''
+        logs, merged = list(), list()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith('.log'):
+                logs.append(int(name.split('.')[0]))
+            elif name.endswith('.merged'):
+                merged.append(int(name.split('.')[0]))
+        last_merge = max(merged) if merged else -1
+        #anything at or before the latest merge has been merged into it
+        for segment_id in merged:
+            if segment_id < last_merge:
+                self._remove_files(Segment(
+                    self._segment_path(segment_id, True), segment_id))
+        for segment_id in logs:
+            if segment_id <= last_merge:
+                self._remove_files(Segment(self._segment_path(segment_id),
+                                           segment_id))
+        segments = [Segment(self._segment_path(segment_id), segment_id)
+                    for segment_id in sorted(logs) if segment_id > last_merge]
+        if merged:
+            segments.insert(0, Segment(self._segment_path(last_merge, True),
+                                       last_merge, merged=True))
+        for segment in segments:
+            self.segments[segment.id] = segment
+            if os.path.exists(segment.hint_path):
+                records = iter_hints(segment.hint_path)
+            else:
+                records = iter_records(segment.path)
+            for flag, key, offset, length in records:
+                pk = hashable(self.codec.loads(key))
+                self._apply(segment.id, flag, pk, offset, length, len(key))
+                segment.size = offset + length
+            if os.path.getsize(segment.path) > segment.size:
+                #drop a record torn by a crash
+                with open(segment.path, 'r+b') as segment_file:
+                    segment_file.truncate(segment.size)
+        self.total_bytes = sum(segment.size
+                               for segment in self.segments.values())
+        if segments and not segments[-1].merged and \
+                not os.path.exists(segments[-1].hint_path):
+            self._open(segments[-1])
+        else:
+            self._open(Segment(self._segment_path(self._next_id()),
+                               self._next_id()))
+
+    def _next_id(self):
+        return max(self.segments.keys() or [-1]) + 1
+
+    def _open(self, segment):
+        self.segments[segment.id] = segment
+        self.active = segment
+        self.writer = open(segment.path, 'ab')
+        segment.reader = open(segment.path, 'rb')
+
+    def _remove_files(self, segment):
+        segment.close()
+        for path in (segment.path, segment.hint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _apply(self, segment_id, flag, pk, offset, length, key_length):
+        previous = self.index.pop(pk, None)
+        if previous is not None:
+            self.live_bytes[previous[0]] -= previous[2]
+        if flag == PUT:
+            self.index[pk] = (segment_id, offset, length, key_length)
+            self.live_bytes[segment_id] = \
+                self.live_bytes.get(segment_id, 0) + length
+
+    def _encode(self, value):
+        data = self.codec.dumps(value)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+
+    def _append(self, flag, pk, data=''):
+        key = self._encode(pk)
+        body = key + data
+        record = RECORD.pack(zlib.crc32(chr(flag) + body) & 0xffffffff,
+                             flag, len(key), len(data)) + body
+        segment = self.active
+        offset = segment.size
+        self.writer.write(record)
+        segment.size += len(record)
+        self.total_bytes += len(record)
+        self._apply(segment.id, flag, pk, offset, len(record), len(key))
+
+    def _flush(self):
+        self.writer.flush()
+        if self.sync:
+            os.fsync(self.writer.fileno())
+        if self.active.size >= self.segment_size:
+            self._roll()
+        if self.compact_ratio is not None and \
+                not (self.compactor and self.compactor.is_alive()) and \
+                self._needs_compaction():
+            self.compactor = threading.Thread(target=self.compact)
+            self.compactor.daemon = True
+            self.compactor.start()
+
+    def _sealed_segments(self):
+        return [segment for segment in self.segments.values()
+                if segment is not self.active]
+
+    def _needs_compaction(self):
+        '''
+        Returns whether merging the sealed segments would reclaim more than
+        compact_ratio of their bytes, a lone merged segment has nothing to
+        merge with
+        '''
+        sealed = self._sealed_segments()
+        if not sealed or (len(sealed) == 1 and sealed[0].merged):
+            return False
+        size = sum(segment.size for segment in sealed)
+        live = sum(self.live_bytes.get(segment.id, 0) for segment in sealed)
+        return size - live > self.compact_ratio * size
+
+    def _roll(self):
+        '''
+        Seals the active segment and starts writing to a new one
+        '''
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        segment = self.active
+        segment.reader.close()
+        segment.reader = None
+        segment.write_hints()
+        self._open(Segment(self._segment_path(self._next_id()),
+                           self._next_id()))
+
+    def _read_record(self, location):
+        segment_id, offset, length, key_length = location
+        return self.segments[segment_id].read(offset, length)
+
+    def __getitem__(self, pk):
+        with self.lock:
+            location = self.index[pk]
+            record = self._read_record(location)
+        return self.codec.loads(record[RECORD.size + location[3]:])
+
+    def __setitem__(self, pk, obj):
+        data = self._encode(obj)
+        with self.lock:
+            self._append(PUT, pk, data)
+            self._flush()
+
+    def __delitem__(self, pk):
+        with self.lock:
+            if pk not in self.index:
+                raise KeyError(pk)
+            self._append(TOMBSTONE, pk)
+            self._flush()
+
+    def __contains__(self, pk):
+        return pk in self.index
+
+    def __iter__(self):
+        return iter(list(self.index.keys()))
+
+    def __len__(self):
+        return len(self.index)
+
+    def update(self, objects):
+        '''
+        Appends a batch of objects with a single flush
+        '''
+        items = [(pk, self._encode(obj)) for pk, obj in objects.items()]
+        with self.lock:
+            for pk, data in items:
+                self._append(PUT, pk, data)
+            self._flush()
+
+    def clear(self):
+        with self.lock:
+            for pk in list(self.index.keys()):
+                self._append(TOMBSTONE, pk)
+            self._flush()
+
+    def compact(self):
+        '''
+        Merges the live records of the sealed segments into a single segment,
+        returns False if there was nothing to merge
+        '''
+        with self.lock:
+            sealed = self._sealed_segments()
+            if self.compacting or not sealed or \
+                    (len(sealed) == 1 and sealed[0].merged):
+                return False
+            self.compacting = True
+            sealed_ids = set(segment.id for segment in sealed)
+            live = [(pk, location) for pk, location in self.index.items()
+                    if location[0] in sealed_ids]
+        try:
+            merged = Segment(self._segment_path(sealed[-1].id, True),
+                             sealed[-1].id, merged=True)
+            moved = list()
+            with open(merged.path + '.tmp', 'wb') as output:
+                for pk, location in live:
+                    with self.lock:
+                        record = self._read_record(location)
+                    moved.append((pk, location, (merged.id, merged.size,
+                                                 location[2], location[3])))
+                    output.write(record)
+                    merged.size += len(record)
+                output.flush()
+                os.fsync(output.fileno())
+            os.rename(merged.path + '.tmp', merged.path)
+            merged.write_hints()
+            with self.lock:
+                for pk, old, new in moved:
+                    #objects written since the copy was taken stay put
+                    if self.index.get(pk) == old:
+                        self.index[pk] = new
+                for segment in sealed:
+                    del self.segments[segment.id]
+                    self.live_bytes.pop(segment.id, None)
+                    self._remove_files(segment)
+                segments = [merged] + list(self.segments.values())
+                self.segments = OrderedDict((segment.id, segment)
+                                            for segment in segments)
+                self.total_bytes = sum(segment.size for segment in segments)
+                self.live_bytes[merged.id] = sum(
+                    location[2] for location in self.index.values()
+                    if location[0] == merged.id)
+        finally:
+            self.compacting = False
+        return True
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            for segment in self.segments.values():
+                segment.close()
+
+
+class LogDataStore(MemoryDataStore):
+    '''
+    A MemoryDataStore whose collections are persisted as segment logs in a
+    directory per collection, secondary indexes are rebuilt on first use
+    '''
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 compact_ratio=0.5, codec='json', sync=False):
+        '''
+        Segments are sealed once they reach segment_size bytes. When more
+        than compact_ratio of the bytes on disk are dead the sealed segments
+        are merged in a background thread, pass None to only compact on
+        demand. With sync every write is fsynced.
+        '''
+        super(LogDataStore, self).__init__()
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.codec = get_codec(codec)
+        self.sync = sync
+
+    def _get_cstore(self, collection):
+        with self.lock:
+            if collection.name not in self.collections:
+                directory = os.path.join(self.directory,
+                                         collection.name or 'default')
+                self.collections[collection.name] = SegmentLog(
+                    directory, self.codec, self.segment_size,
+                    self.compact_ratio, self.sync)
+            return self.collections[collection.name]
+
+    def compact(self):
+        for log in self.collections.values():
+            log.compact()
+
+    def close(self):
+        for log in self.collections.values():
+            log.close()
@@ -1,23 +1,229 @@
 # -*- coding: utf-8 -*-
-from .core import BaseDataStore
+import bisect
+import itertools
+import threading
+
+from .core import BaseDataStore, IndexStats, LOOKUPS, RANGE_LOOKUPS, \
+    split_lookup
+
+
+NotFound = object()
+
+
+def match_object(pk, obj, params):
+    for param, value in params.items():
+        field, lookup = split_lookup(param)
+        if field == 'pk':
+            stored = pk
+        else:
+            stored = obj.get(field)
+        if not LOOKUPS[lookup](stored, value):
+            return False
+    return True
+
+
+def match_chunk(chunk):
+    '''
+    Returns the (pk, obj) items of a (params, items) chunk matching the
+    params, at module level so process pools can pickle it
+    '''
+    params, items = chunk
+    return [(pk, obj) for pk, obj in items if match_object(pk, obj, params)]
+
+
+class HashIndex(object):
+    '''
+    Maps the values of a field to the set of pks having that value
+    '''
+    def __init__(self, field):
+        self.field = field
+        self.buckets = dict()
+        # pk => indexed value, so stale entries can be dropped without
+        # relying on the previously stored object
+        self.values = dict()
+        # pks whose value can't be hashed are always candidates
+        self.unhashable = set()
+
+    def add(self, pk, obj):
+        self.discard(pk)
+        value = obj.get(self.field)
+        try:
+            self.buckets.setdefault(value, set()).add(pk)
+        except TypeError:
+            self.unhashable.add(pk)
+        else:
+            self.values[pk] = value
+
+    def discard(self, pk):
+        self.unhashable.discard(pk)
+        if pk not in self.values:
+            return
+        value = self.values.pop(pk)
+        bucket = self.buckets[value]
+        bucket.discard(pk)
+        if not bucket:
+            del self.buckets[value]
+
+    def lookup(self, lookup, value):
+        '''
+        Returns the set of candidate pks for the lookup or None if the index
+        can not answer it
+        '''
+        if lookup == 'exact':
+            values = [value]
+        elif lookup == 'in':
+            values = value
+        else:
+            return None
+        pks = set(self.unhashable)
+        for value in values:
+            try:
+                pks.update(self.buckets.get(value, ()))
+            except TypeError:
+                return None
+        return pks
+
+    def stats(self):
+        return IndexStats(len(self.buckets),
+                          len(self.values) + len(self.unhashable))
+
+
+class SortedIndex(object):
+    '''
+    Keeps the pks ordered by the value of a field, answering equality and
+    range lookups with bisection and iterating in field order
+    '''
+    def __init__(self, field):
+        self.field = field
+        # parallel lists ordered by value
+        self.sorted_values = list()
+        self.sorted_pks = list()
+        self.values = dict()
+
+    def add(self, pk, obj):
+        self.discard(pk)
+        value = obj.get(self.field)
+        position = bisect.bisect_right(self.sorted_values, value)
+        self.sorted_values.insert(position, value)
+        self.sorted_pks.insert(position, pk)
+        self.values[pk] = value
+
+    def discard(self, pk):
+        if pk not in self.values:
+            return
+        value = self.values.pop(pk)
+        lo = bisect.bisect_left(self.sorted_values, value)
+        hi = bisect.bisect_right(self.sorted_values, value)
+        position = self.sorted_pks.index(pk, lo, hi)
+        del self.sorted_values[position]
+        del self.sorted_pks[position]
+
+    def bounds(self, lookup, value):
+        '''
+        Returns the (lo, hi) positions of the entries matching the lookup or
+        None if the matches are not contiguous
+        '''
+        values = self.sorted_values
+        if lookup == 'exact':
+            return (bisect.bisect_left(values, value),
+                    bisect.bisect_right(values, value))
+        if lookup == 'lt':
+            return 0, bisect.bisect_left(values, value)
+        if lookup == 'lte':
+            return 0, bisect.bisect_right(values, value)
+        if lookup == 'gt':
+            return bisect.bisect_right(values, value), len(values)
+        if lookup == 'gte':
+            return bisect.bisect_left(values, value), len(values)
+        return None
+
+    def lookup(self, lookup, value):
+        if lookup == 'in':
+            pks = set()
+            for item in value:
+                lo, hi = self.bounds('exact', item)
+                pks.update(self.sorted_pks[lo:hi])
+            return pks
+        bounds = self.bounds(lookup, value)
+        if bounds is None:
+            return None
+        return set(self.sorted_pks[bounds[0]:bounds[1]])
+
+    def count(self, lookup, value):
+        if lookup == 'in':
+            return sum(self.count('exact', item) for item in value)
+        bounds = self.bounds(lookup, value)
+        if bounds is None:
+            return None
+        return max(0, bounds[1] - bounds[0])
+
+    def iter_pks(self, lo=0, hi=None, reverse=False):
+        '''
+        Returns a copy of the pks from lo up to hi, so saves made while
+        walking them don't shift the entries
+        '''
+        if hi is None:
+            hi = len(self.sorted_pks)
+        pks = self.sorted_pks[lo:hi]
+        if reverse:
+            pks.reverse()
+        return pks
+
+    def stats(self):
+        #the counter gives exact estimates so cardinality isn't tracked
+        return IndexStats(None, len(self.values), counter=self.count)
 
 
 class MemoryDataStore(BaseDataStore):
     def __init__(self):
         super(MemoryDataStore, self).__init__()
         self.collections = dict()
+        self.indexes = dict()
+        #writes and the snapshots taken by reads are serialized so the store
+        #can be shared by threads, hooks are run outside of the lock
+        self.lock = threading.RLock()
 
     def _get_cstore(self, collection):
-        if collection.name not in self.collections:
-            self.collections[collection.name] = dict()
-        return self.collections[collection.name]
+        with self.lock:
+            if collection.name not in self.collections:
+                self.collections[collection.name] = dict()
+            return self.collections[collection.name]
+
+    def _get_indexes(self, collection):
+        '''
+        Returns the secondary indexes declared by the collection, building any
+        that are missing from the stored objects
+        '''
+        declared = [(field, SortedIndex)
+                    for field in collection.sorted_indexes]
+        declared.extend((field, HashIndex) for field in collection.indexes
+                        if field not in collection.sorted_indexes)
+        with self.lock:
+            indexes = self.indexes.setdefault(collection.name, dict())
+            for field, index_class in declared:
+                if not isinstance(indexes.get(field), index_class):
+                    index = index_class(field)
+                    for pk, obj in self._get_cstore(collection).items():
+                        index.add(pk, obj)
+                    indexes[field] = index
+        return indexes
+
+    def _index_object(self, collection, pk, obj):
+        for index in self._get_indexes(collection).values():
+            index.add(pk, obj)
+
+    def _unindex_object(self, collection, pk):
+        for index in self._get_indexes(collection).values():
+            index.discard(pk)
 
     def save(self, collection, instance, key=None):
         instance = self.execute_hooks('beforeSave',
             {'instance': instance, 'collection': collection})
         pk = key or collection.get_object_id(instance)
-        cstore = self._get_cstore(collection)
-        cstore[pk] = collection.get_serializable(instance)
+        obj = collection.get_serializable(instance)
+        with self.lock:
+            self._get_cstore(collection)[pk] = obj
+            self._index_object(collection, pk, obj)
         return self.execute_hooks('afterSave',
             {'instance': instance, 'collection': collection})
 
@@ -25,47 +231,233 @@ class MemoryDataStore(BaseDataStore):
         instance = self.execute_hooks('beforeRemove',
             {'instance': instance, 'collection': collection})
         pk = collection.get_object_id(instance)
-        cstore = self._get_cstore(collection)
-        cstore.pop(pk, None)
+        with self.lock:
+            self._get_cstore(collection).pop(pk, None)
+            self._unindex_object(collection, pk)
         return self.execute_hooks('afterRemove',
             {'instance': instance, 'collection': collection})
 
+    def save_many(self, collection, instances, keys=None):
+        instances = self.execute_batch_hooks('beforeSave', collection,
+                                             list(instances))
+        if keys is None:
+            keys = [None] * len(instances)
+        objects = dict()
+        for instance, key in zip(instances, keys):
+            pk = key or collection.get_object_id(instance)
+            objects[pk] = collection.get_serializable(instance)
+        with self.lock:
+            self._get_cstore(collection).update(objects)
+            for pk, obj in objects.iteritems():
+                self._index_object(collection, pk, obj)
+        return self.execute_batch_hooks('afterSave', collection, instances)
+
+    def remove_many(self, collection, instances):
+        instances = self.execute_batch_hooks('beforeRemove', collection,
+                                             list(instances))
+        with self.lock:
+            cstore = self._get_cstore(collection)
+            for instance in instances:
+                pk = collection.get_object_id(instance)
+                cstore.pop(pk, None)
+                self._unindex_object(collection, pk)
+        return self.execute_batch_hooks('afterRemove', collection, instances)
+
     def get(self, collection, params):
         params = self._normalize_params(collection, params)
         if 'pk' in params:
             cstore = self._get_cstore(collection)
             return cstore[params['pk']]
-        return self.find(collection, params)[0]
+        for obj in self.find(collection, params):
+            return obj
+        raise KeyError('Not found: %s' % params)
+
+    def get_many(self, collection, pks):
+        cstore = self._get_cstore(collection)
+        with self.lock:
+            return dict((pk, cstore[pk]) for pk in pks if pk in cstore)
+
+    def get_index_stats(self, collection):
+        stats = dict()
+        with self.lock:
+            for field, index in self._get_indexes(collection).items():
+                stats[field] = index.stats()
+        return stats
+
+    def _lookup_pks(self, collection, param, value):
+        field, lookup = split_lookup(param)
+        if field == 'pk':
+            return set([value]) if lookup == 'exact' else set(value)
+        return self._get_indexes(collection)[field].lookup(lookup, value)
+
+    def _candidate_pks(self, collection, params):
+        '''
+        Returns the set of pks the query plan narrows the params down to,
+        or None if a full scan is required
+        '''
+        plan = self.planner_class(self).plan(collection, params)
+        candidates = None
+        with self.lock:
+            for step in plan.index_steps():
+                pks = self._lookup_pks(collection, step.param,
+                                       params[step.param])
+                if pks is None:
+                    continue
+                if candidates is None:
+                    candidates = pks
+                else:
+                    candidates &= pks
+        return candidates
+
+    def _match(self, pk, obj, params):
+        return match_object(pk, obj, params)
+
+    def _find_items(self, collection, params, parallel=None):
+        '''
+        Yields (pk, obj) pairs matching the normalized params, in chunks
+        matched by the executor of the parallel options if given
+        '''
+        cstore = self._get_cstore(collection)
+        with self.lock:
+            pks = self._candidate_pks(collection, params)
+            if pks is None:
+                pks = cstore.keys()
+            pks = list(pks)
+        items = self._iter_items(cstore, pks)
+        if parallel:
+            chunks = self._iter_chunks(params, items, parallel['chunk_size'])
+            matches = parallel['executor'].map(match_chunk, chunks,
+                                               parallel['ordered'])
+            for chunk in matches:
+                for item in chunk:
+                    yield item
+            return
+        for pk, obj in items:
+            if self._match(pk, obj, params):
+                yield pk, obj
+
+    def _iter_items(self, cstore, pks):
+        '''
+        Yields the (pk, obj) pairs of a snapshot of the pks, results are
+        consumed lazily so objects saved or removed in the meantime must not
+        break the iteration
+        '''
+        for pk in pks:
+            obj = cstore.get(pk, NotFound)
+            if obj is not NotFound:
+                yield pk, obj
 
-    def find(self, collection, params):
+    def _iter_chunks(self, params, items, chunk_size):
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                return
+            yield params, chunk
+
+    def _find_ordered_items(self, collection, params, order_by,
+                            parallel=None):
+        '''
+        Yields (pk, obj) pairs matching the normalized params in the order
+        of the ordering fields
+        '''
         cstore = self._get_cstore(collection)
-        if params:
-            params = self._normalize_params(collection, params)
-            objects = list()
-            for pk, obj in cstore.items():
-                match = True
+        field = order_by[0].lstrip('-')
+        index = self._get_indexes(collection).get(field)
+        if len(order_by) == 1 and isinstance(index, SortedIndex):
+            pks = None
+            with self.lock:
+                #restrict the walk to the range lookups on the ordered field
+                lo, hi = 0, len(index.sorted_pks)
                 for param, value in params.items():
-                    if param == 'pk':
-                        match &= value == pk
-                    elif param == 'pk__in':
-                        match &= pk in value
-                    elif param.endswith('__in'):
-                        param = param[:-len('__in')]
-                        match &= obj.get(param) in value
-                    else:
-                        match &= obj.get(param) == value
-                    if not match:
-                        break
-                if match:
-                    objects.append(obj)
-            return objects
-        return cstore.values()
+                    param_field, lookup = split_lookup(param)
+                    if param_field == field and \
+                            (lookup == 'exact' or lookup in RANGE_LOOKUPS):
+                        bounds = index.bounds(lookup, value)
+                        lo, hi = max(lo, bounds[0]), min(hi, bounds[1])
+                candidates = self._candidate_pks(collection, params)
+                if candidates is None or len(candidates) >= hi - lo:
+                    pks = index.iter_pks(lo, hi,
+                                         reverse=order_by[0].startswith('-'))
+            if pks is not None:
+                for pk in pks:
+                    obj = cstore.get(pk, NotFound)
+                    if obj is not NotFound and self._match(pk, obj, params):
+                        yield pk, obj
+                return
+
+        def getter(item, field):
+            if field == 'pk':
+                return item[0]
+            return item[1].get(field)
+
+        items = self._find_items(collection, params, parallel)
+        for item in self._order_results(items, order_by, getter):
+            yield item
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        cstore = self._get_cstore(collection)
+        params = self._normalize_params(collection, params)
+        windowed = limit is not None or offset
+        if order_by:
+            order_by = self._normalize_ordering(collection, order_by)
+            items = self._find_ordered_items(collection, params, order_by,
+                                             parallel)
+            results = (obj for pk, obj in items)
+        elif params:
+            items = self._find_items(collection, params, parallel)
+            results = (obj for pk, obj in items)
+            if not windowed:
+                results = list(results)
+        elif windowed:
+            with self.lock:
+                pks = list(cstore.keys())
+            results = (obj for pk, obj in self._iter_items(cstore, pks))
+        else:
+            with self.lock:
+                results = list(cstore.values())
+        results = self._apply_window(results, limit, offset)
+        return self._project_results(collection, results, only, defer)
+
+    def count(self, collection, params):
+        if not params:
+            return len(self._get_cstore(collection))
+        params = self._normalize_params(collection, params)
+        return sum(1 for item in self._find_items(collection, params))
+
+    def keys(self, collection, params):
+        if not params:
+            return list(self._get_cstore(collection).keys())
+        params = self._normalize_params(collection, params)
+        return [pk for pk, obj in self._find_items(collection, params)]
+
+    def exists(self, collection, params):
+        params = self._normalize_params(collection, params)
+        for item in self._find_items(collection, params):
+            return True
+        return False
 
     def delete(self, collection, params):
         cstore = self._get_cstore(collection)
-        objects = self.find(collection, params)
-        for obj in objects:
-            pk = obj.get(collection.object_id_field)
-            cstore.pop(pk)
-        return self.execute_hooks('afterDelete',
-            {'collection': collection})
+        params = self._normalize_params(collection, params)
+        with self.lock:
+            if not params:
+                deleted = len(cstore)
+                cstore.clear()
+                self.indexes.pop(collection.name, None)
+            else:
+                if set(params.keys()) <= set(['pk', 'pk__in']):
+                    #key driven, the stored objects need not be looked at
+                    pks = [pk for pk
+                           in self._candidate_pks(collection, params)
+                           if self._match(pk, None, params)]
+                else:
+                    pks = [pk for pk, obj
+                           in self._find_items(collection, params)]
+                deleted = 0
+                for pk in pks:
+                    if cstore.pop(pk, NotFound) is not NotFound:
+                        self._unindex_object(collection, pk)
+                        deleted += 1
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return deleted
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+'''
+Partitions each collection by pk over several child data stores. Lookups by
+pk are routed to the shard owning the pk, other queries are sent to every
+shard at once and their results merged.
+'''
+from __future__ import absolute_import
+
+import bisect
+import hashlib
+import heapq
+import itertools
+from microcollections.executors import ThreadExecutor
+from .core import BaseDataStore
+
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''
+    Consistent hashing of pks over named nodes. Each node is placed at
+    replicas points of the ring so adding or removing a node only moves the
+    pks of the neighbouring points.
+    '''
+    def __init__(self, nodes, replicas=100):
+        self.replicas = replicas
+        self.ring = list()
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        for replica in range(self.replicas):
+            bisect.insort(self.ring, (hash_key('%s:%s' % (node, replica)),
+                                      node))
+
+    def remove_node(self, node):
+        self.ring = [point for point in self.ring if point[1] != node]
+
+    def get_node(self, pk):
+        position = bisect.bisect(self.ring, (hash_key(pk),))
+        return self.ring[position % len(self.ring)][1]
+
+
+class RangePartitioner(object):
+    '''
+    Assigns pks below boundaries[0] to nodes[0], pks from boundaries[0] up to
+    boundaries[1] to nodes[1] and so on
+    '''
+    def __init__(self, boundaries, nodes):
+        assert len(nodes) == len(boundaries) + 1
+        self.boundaries = list(boundaries)
+        self.nodes = list(nodes)
+
+    def get_node(self, pk):
+        return self.nodes[bisect.bisect_right(self.boundaries, pk)]
+
+
+class Descending(object):
+    '''
+    Inverts the ordering of a value in a sort key
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
+
+class ShardCollection(object):
+    '''
+    Stands in for a collection in the deletes sent to the shards, so the
+    afterDelete hook is only run once by the sharded store
+    '''
+    def __init__(self, collection):
+        self.collection = collection
+
+    def afterDelete(self):
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class ShardedDataStore(BaseDataStore):
+    #published by the sharded store itself, once for all the shards
+    local_topics = ('afterDelete',)
+
+    def __init__(self, shards, partitioner=None, replicas=100, workers=None,
+                 executor=None):
+        '''
+        shards maps shard names to data stores, a list of data stores is
+        named by position. pks are placed with a HashRing of the names unless
+        a partitioner (anything with get_node(pk) returning a name, such as
+        RangePartitioner) is given.
+
+        Queries are sent to the shards by the executor, a ThreadExecutor of
+        workers threads (one per shard by default) unless given. It is sent
+        closures over the shards, so it can't be a ProcessExecutor.
+        '''
+        super(ShardedDataStore, self).__init__()
+        if not isinstance(shards, dict):
+            shards = dict(('shard%s' % index, shard)
+                          for index, shard in enumerate(shards))
+        self.shards = shards
+        if partitioner is None:
+            partitioner = HashRing(sorted(shards.keys()), replicas)
+        self.partitioner = partitioner
+        if executor is None:
+            executor = ThreadExecutor(workers or len(shards))
+        self.executor = executor
+
+    def get_shard(self, pk):
+        return self.shards[self.partitioner.get_node(pk)]
+
+    def _group_by_shard(self, pks):
+        '''
+        Returns a list of (shard, pks) of the shards owning the pks
+        '''
+        groups = dict()
+        for pk in pks:
+            groups.setdefault(self.partitioner.get_node(pk), list()).append(pk)
+        return [(self.shards[name], group) for name, group in groups.items()]
+
+    def _map(self, func, items):
+        '''
+        Calls func on every item with the executor, returning the results in
+        order
+        '''
+        items = list(items)
+        if len(items) < 2:
+            return map(func, items)
+        return list(self.executor.map(func, items))
+
+    def _target_shards(self, collection, params):
+        '''
+        Returns the shards that may hold matches of the params
+        '''
+        params = self._normalize_params(collection, params)
+        if 'pk' in params:
+            return [self.get_shard(params['pk'])]
+        if 'pk__in' in params:
+            return [shard for shard, pks
+                    in self._group_by_shard(params['pk__in'])]
+        return self.shards.values()
+
+    def subsribe(self, topic, callback):
+        if topic in self.local_topics:
+            return super(ShardedDataStore, self).subsribe(topic, callback)
+        for shard in self.shards.values():
+            shard.subsribe(topic, callback)
+
+    def publish(self, topic, message):
+        if topic in self.local_topics:
+            return super(ShardedDataStore, self).publish(topic, message)
+        #every shard holds the same subscribers
+        shard = self.shards.values()[0]
+        return shard.publish(topic, message)
+
+    def _get_pk(self, collection, instance, key=None):
+        '''
+        Returns the pk of the instance, setting generated pks on the instance
+        so the shard stores it under the pk it was routed by
+        '''
+        if key:
+            return key
+        pk = collection.get_object_id(instance)
+        collection._set_object_id(instance, pk)
+        return pk
+
+    def save(self, collection, instance, key=None):
+        pk = self._get_pk(collection, instance, key)
+        return self.get_shard(pk).save(collection, instance, pk)
+
+    def remove(self, collection, instance):
+        pk = collection.get_object_id(instance)
+        return self.get_shard(pk).remove(collection, instance)
+
+    def save_many(self, collection, instances, keys=None):
+        instances = list(instances)
+        if keys is None:
+            keys = [None] * len(instances)
+        groups = dict()
+        for instance, key in zip(instances, keys):
+            pk = self._get_pk(collection, instance, key)
+            group = groups.setdefault(self.partitioner.get_node(pk),
+                                      (list(), list()))
+            group[0].append(instance)
+            group[1].append(pk)
+        results = list()
+        for name, (batch, pks) in groups.items():
+            results.extend(self.shards[name].save_many(collection, batch, pks))
+        return results
+
+    def remove_many(self, collection, instances):
+        groups = dict()
+        for instance in instances:
+            name = self.partitioner.get_node(
+                collection.get_object_id(instance))
+            groups.setdefault(name, list()).append(instance)
+        results = list()
+        for name, batch in groups.items():
+            results.extend(self.shards[name].remove_many(collection, batch))
+        return results
+
+    def get(self, collection, params):
+        normalized = self._normalize_params(collection, params)
+        if 'pk' in normalized:
+            return self.get_shard(normalized['pk']).get(collection, params)
+        for obj in self.find(collection, params, limit=1):
+            return obj
+        raise KeyError('Not found: %s' % params)
+
+    def get_many(self, collection, pks):
+        def fetch(group):
+            return group[0].get_many(collection, group[1])
+
+        results = dict()
+        for found in self._map(fetch, self._group_by_shard(pks)):
+            results.update(found)
+        return results
+
+    def _sort_key(self, collection, order_by):
+        fields = list()
+        for field in order_by:
+            descending = field.startswith('-')
+            field = field.lstrip('-')
+            if field == 'pk':
+                field = collection.object_id_field
+            fields.append((field, descending))
+
+        def key(result):
+            return tuple(Descending(result.get(field)) if descending
+                         else result.get(field)
+                         for field, descending in fields)
+        return key
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        #each shard returns enough results to fill the window on its own
+        shard_limit = None if limit is None else (offset or 0) + limit
+        shards = self._target_shards(collection, params)
+        merged = bool(order_by) and len(shards) > 1
+        shard_only, shard_defer = only, defer
+        if merged:
+            #the shards must return the fields the results are merged by
+            fields = [field.lstrip('-') for field in order_by]
+            if only:
+                shard_only = list(only) + fields
+            if defer:
+                shard_defer = [field for field in defer if field not in fields]
+
+        def fetch(shard):
+            return shard.find(collection, params, order_by=order_by,
+                              limit=shard_limit, only=shard_only,
+                              defer=shard_defer, parallel=parallel)
+
+        if not merged:
+            #a shard is only queried once the previous ones are exhausted
+            results = itertools.chain.from_iterable(
+                itertools.imap(fetch, shards))
+            return self._apply_window(results, limit, offset)
+        if shard_limit is None:
+            #the shards are streamed, holding a result of each at a time
+            pages = [fetch(shard) for shard in shards]
+        else:
+            #windows are small enough to fetch from the shards in parallel
+            pages = self._map(lambda shard: list(fetch(shard)), shards)
+        key = self._sort_key(collection, order_by)
+        #heapq.merge has no key argument, decorate with the key and a
+        #tie breaker so results are never compared
+        decorated = [((key(result), index, position, result)
+                      for position, result in enumerate(page))
+                     for index, page in enumerate(pages)]
+        results = (item[-1] for item in heapq.merge(*decorated))
+        results = self._apply_window(results, limit, offset)
+        return self._project_results(collection, results, only, defer)
+
+    def count(self, collection, params):
+        def count(shard):
+            return shard.count(collection, params)
+        return sum(self._map(count, self._target_shards(collection, params)))
+
+    def exists(self, collection, params):
+        def exists(shard):
+            return shard.exists(collection, params)
+        return any(self._map(exists, self._target_shards(collection, params)))
+
+    def keys(self, collection, params):
+        def keys(shard):
+            return list(shard.keys(collection, params))
+        shards = self._target_shards(collection, params)
+        return [pk for found in self._map(keys, shards) for pk in found]
+
+    def delete(self, collection, params):
+        shard_collection = ShardCollection(collection)
+
+        def delete(shard):
+            return shard.delete(shard_collection, params)
+        deleted = sum(self._map(delete,
+                                self._target_shards(collection, params)))
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return deleted
+
+    def rebalance(self, collection):
+        '''
+        Moves the objects stored on a shard that no longer owns their pk,
+        after shards were added to or removed from the partitioner. Returns
+        the number of objects moved.
+        '''
+        moved = 0
+        for name, shard in self.shards.items():
+            misplaced = [pk for pk in shard.keys(collection, {})
+                         if self.partitioner.get_node(pk) != name]
+            if not misplaced:
+                continue
+            objects = shard.get_many(collection, misplaced)
+            for owner, pks in self._group_by_shard(objects.keys()):
+                instances = [shard.load_instance(collection, objects[pk])
+                             for pk in pks]
+                owner.save_many(collection, instances, pks)
+            #the objects moved, they were not deleted
+            shard.delete(ShardCollection(collection), {'pk__in': misplaced})
+            moved += len(objects)
+        return moved
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+'''
+A data store persisting each collection as a sqlite table of pks and JSON
+documents. Fields declared in a collection's indexes or sorted_indexes get an
+expression index so lookups on them don't scan the table.
+'''
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from microcollections.codecs import get_codec
+from .core import BaseDataStore, IndexStats, split_lookup
+
+
+OPERATORS = {
+    'exact': '=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+}
+
+
+def quote_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SQLiteDataStore(BaseDataStore):
+    #rows fetched from the cursor at a time while streaming results
+    fetch_size = 500
+    #pks bound per statement, sqlite limits the number of parameters. Longer
+    #__in lookups are bound as a single JSON array
+    batch_size = 500
+
+    def __init__(self, path, codec='json', timeout=5.0):
+        '''
+        path is the database file, it is opened by a connection per thread
+        and process in WAL mode so readers don't block the writer.
+
+        codec must produce JSON for the documents to be queryable.
+
+        The store can be used as a context manager closing it on exit.
+        '''
+        super(SQLiteDataStore, self).__init__()
+        self.path = path
+        self.codec = get_codec(codec)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = list()
+        self.tables = dict()
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self):
+        #connections are used by a single thread, but close() may be called
+        #from any of them
+        connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _get_connection(self):
+        '''
+        Returns a connection for the current thread, reconnecting in forked
+        processes
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = self._connect()
+            self.local.pid = os.getpid()
+            with self.lock:
+                self.connections.append((os.getpid(), self.local.connection))
+        return self.local.connection
+
+    def close(self):
+        '''
+        Closes the connections of every thread, the store reconnects when it
+        is used again
+        '''
+        with self.lock:
+            connections, self.connections = self.connections, list()
+            self.local = threading.local()
+        for pid, connection in connections:
+            #connections inherited from a parent process are left to it
+            if pid == os.getpid():
+                connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        committed = False
+        try:
+            yield connection
+            connection.execute('COMMIT')
+            committed = True
+        finally:
+            if not committed:
+                connection.execute('ROLLBACK')
+
+    def get_table_name(self, collection):
+        return collection.name or 'default'
+
+    def _get_table(self, collection):
+        '''
+        Returns the quoted table name of the collection, creating the table
+        and the indexes it declares when they are missing
+        '''
+        name = self.get_table_name(collection)
+        fields = tuple(collection.sorted_indexes) + tuple(
+            field for field in collection.indexes
+            if field not in collection.sorted_indexes)
+        if self.tables.get(name) == fields:
+            return quote_name(name)
+        with self.lock:
+            connection = self._get_connection()
+            #the pk column has no type so ints and strings keep their type
+            connection.execute('CREATE TABLE IF NOT EXISTS %s '
+                               '(pk PRIMARY KEY, data TEXT)' %
+                               quote_name(name))
+            for field in fields:
+                connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                                   % (quote_name('%s__%s' % (name, field)),
+                                      quote_name(name),
+                                      self._field_expression(field)))
+            self.tables[name] = fields
+        return quote_name(name)
+
+    def _field_expression(self, field):
+        '''
+        Returns the SQL expression of a field, paths are inlined so the
+        expression matches the one the index was created on
+        '''
+        if field == 'pk':
+            return 'pk'
+        path = '$."%s"' % field
+        return "json_extract(data, '%s')" % path.replace("'", "''")
+
+    def _where(self, params):
+        '''
+        Returns the WHERE clause and its arguments for normalized params
+        '''
+        clauses, args = list(), list()
+        for param, value in sorted(params.items()):
+            field, lookup = split_lookup(param)
+            expression = self._field_expression(field)
+            if lookup == 'in':
+                values = list(value)
+                if not values:
+                    clauses.append('0')
+                elif len(values) > self.batch_size:
+                    clauses.append('%s IN (SELECT value FROM json_each(?))'
+                                   % expression)
+                    args.append(self.codec.dumps(values))
+                else:
+                    clauses.append('%s IN (%s)' % (
+                        expression, ', '.join('?' * len(values))))
+                    args.extend(values)
+            elif value is None and lookup == 'exact':
+                clauses.append('%s IS NULL' % expression)
+            elif isinstance(value, (dict, list, tuple)):
+                #json_extract returns containers as minified JSON
+                clauses.append('%s %s json(?)' % (expression,
+                                                  OPERATORS[lookup]))
+                args.append(self.codec.dumps(value))
+            else:
+                clauses.append('%s %s ?' % (expression, OPERATORS[lookup]))
+                args.append(value)
+        if not clauses:
+            return '', args
+        return ' WHERE ' + ' AND '.join(clauses), args
+
+    def _order(self, collection, order_by):
+        if not order_by:
+            return ''
+        terms = list()
+        for field in self._normalize_ordering(collection, order_by):
+            direction = 'DESC' if field.startswith('-') else 'ASC'
+            terms.append('%s %s' % (self._field_expression(field.lstrip('-')),
+                                    direction))
+        return ' ORDER BY ' + ', '.join(terms)
+
+    def _iter_rows(self, cursor):
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def _iter_batches(self, items):
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    def save(self, collection, instance, key=None):
+        instance = self.execute_hooks('beforeSave',
+            {'instance': instance, 'collection': collection})
+        pk = key or collection.get_object_id(instance)
+        table = self._get_table(collection)
+        data = self.codec.dumps(collection.get_serializable(instance))
+        self._get_connection().execute(
+            'INSERT OR REPLACE INTO %s (pk, data) VALUES (?, ?)' % table,
+            (pk, data))
+        return self.execute_hooks('afterSave',
+            {'instance': instance, 'collection': collection})
+
+    def remove(self, collection, instance):
+        instance = self.execute_hooks('beforeRemove',
+            {'instance': instance, 'collection': collection})
+        pk = collection.get_object_id(instance)
+        table = self._get_table(collection)
+        self._get_connection().execute('DELETE FROM %s WHERE pk = ?' % table,
+                                       (pk,))
+        return self.execute_hooks('afterRemove',
+            {'instance': instance, 'collection': collection})
+
+    def save_many(self, collection, instances, keys=None):
+        instances = self.execute_batch_hooks('beforeSave', collection,
+                                             list(instances))
+        if keys is None:
+            keys = [None] * len(instances)
+        table = self._get_table(collection)
+        rows = [(key or collection.get_object_id(instance),
+                 self.codec.dumps(collection.get_serializable(instance)))
+                for instance, key in zip(instances, keys)]
+        with self._transaction() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO %s (pk, data) VALUES (?, ?)' % table,
+                rows)
+        return self.execute_batch_hooks('afterSave', collection, instances)
+
+    def remove_many(self, collection, instances):
+        instances = self.execute_batch_hooks('beforeRemove', collection,
+                                             list(instances))
+        table = self._get_table(collection)
+        pks = [(collection.get_object_id(instance),)
+               for instance in instances]
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM %s WHERE pk = ?' % table, pks)
+        return self.execute_batch_hooks('afterRemove', collection, instances)
+
+    def get(self, collection, params):
+        params = self._normalize_params(collection, params)
+        if params.keys() == ['pk']:
+            table = self._get_table(collection)
+            row = self._get_connection().execute(
+                'SELECT data FROM %s WHERE pk = ?' % table,
+                (params['pk'],)).fetchone()
+            if row is None:
+                raise KeyError('Not found: %s' % params['pk'])
+            return self.codec.loads(row[0])
+        for obj in self.find(collection, params, limit=1):
+            return obj
+        raise KeyError('Not found: %s' % params)
+
+    def get_many(self, collection, pks):
+        table = self._get_table(collection)
+        connection = self._get_connection()
+        results = dict()
+        for batch in self._iter_batches(list(pks)):
+            rows = connection.execute(
+                'SELECT pk, data FROM %s WHERE pk IN (%s)' %
+                (table, ', '.join('?' * len(batch))), batch)
+            for pk, data in rows:
+                results[pk] = self.codec.loads(data)
+        return results
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        table = self._get_table(collection)
+        params = self._normalize_params(collection, params)
+        where, args = self._where(params)
+        query = 'SELECT data FROM %s%s%s' % (table, where,
+                                            self._order(collection, order_by))
+        if limit is not None or offset:
+            query += ' LIMIT ? OFFSET ?'
+            args.extend([-1 if limit is None else limit, offset or 0])
+        cursor = self._get_connection().execute(query, args)
+        results = (self.codec.loads(row[0]) for row in self._iter_rows(cursor))
+        return self._project_results(collection, results, only, defer)
+
+    def count(self, collection, params):
+        table = self._get_table(collection)
+        where, args = self._where(self._normalize_params(collection, params))
+        return self._get_connection().execute(
+            'SELECT COUNT(*) FROM %s%s' % (table, where), args).fetchone()[0]
+
+    def exists(self, collection, params):
+        table = self._get_table(collection)
+        where, args = self._where(self._normalize_params(collection, params))
+        row = self._get_connection().execute(
+            'SELECT 1 FROM %s%s LIMIT 1' % (table, where), args).fetchone()
+        return row is not None
+
+    def keys(self, collection, params):
+        table = self._get_table(collection)
+        where, args = self._where(self._normalize_params(collection, params))
+        cursor = self._get_connection().execute(
+            'SELECT pk FROM %s%s' % (table, where), args)
+        return [row[0] for row in self._iter_rows(cursor)]
+
+    def get_index_stats(self, collection):
+        '''
+        Reports the expression indexes of the collection, estimates are
+        exact counts answered from the index
+        '''
+        table = self._get_table(collection)
+        connection = self._get_connection()
+        stats = dict()
+        for field in self.tables[self.get_table_name(collection)]:
+            size = connection.execute(
+                'SELECT COUNT(*) FROM %s WHERE %s IS NOT NULL' %
+                (table, self._field_expression(field))).fetchone()[0]
+            counter = self._index_counter(table, field)
+            stats[field] = IndexStats(None, size, counter=counter)
+        return stats
+
+    def _index_counter(self, table, field):
+        def counter(lookup, value):
+            if lookup != 'in' and lookup not in OPERATORS:
+                return None
+            param = field if lookup == 'exact' else '%s__%s' % (field, lookup)
+            where, args = self._where({param: value})
+            return self._get_connection().execute(
+                'SELECT COUNT(*) FROM %s%s' % (table, where),
+                args).fetchone()[0]
+        return counter
+
+    def delete(self, collection, params):
+        table = self._get_table(collection)
+        where, args = self._where(self._normalize_params(collection, params))
+        cursor = self._get_connection().execute(
+            'DELETE FROM %s%s' % (table, where), args)
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return cursor.rowcount
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+Executors map a function over items serially, from a pool of threads for I/O
+bound work or from a pool of processes for CPU bound work. Functions and
+items given to a process executor must be picklable, module level functions
+and plain data.
+'''
+from __future__ import absolute_import
+
+import itertools
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+class SerialExecutor(object):
+    def map(self, func, items, ordered=True):
+        return itertools.imap(func, items)
+
+    def close(self):
+        pass
+
+
+class PoolExecutor(object):
+    '''
+    Runs the function in a pool of workers, started on first use
+    '''
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def create_pool(self):
+        raise NotImplementedError
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.create_pool()
+        return self.pool
+
+    def map(self, func, items, ordered=True):
+        '''
+        Returns an iterator of the results, in the order of the items or as
+        they complete when not ordered
+        '''
+        pool = self._get_pool()
+        if ordered:
+            return pool.imap(func, items)
+        return pool.imap_unordered(func, items)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+class ThreadExecutor(PoolExecutor):
+    def create_pool(self):
+        return ThreadPool(self.workers)
+
+
+class ProcessExecutor(PoolExecutor):
+    def create_pool(self):
+        return multiprocessing.Pool(self.workers)
+
+
+EXECUTORS = {
+    'serial': SerialExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+_shared = dict()
+_lock = threading.Lock()
+
+
+def get_executor(executor=None, workers=None):
+    '''
+    Returns the executor itself if it is already an executor, otherwise the
+    executor shared by callers asking for the same kind and workers. None is
+    the serial executor.
+    '''
+    if executor is None:
+        executor = 'serial'
+    if not isinstance(executor, basestring):
+        return executor
+    with _lock:
+        key = (executor, workers)
+        if key not in _shared:
+            if executor == 'serial':
+                _shared[key] = SerialExecutor()
+            else:
+                _shared[key] = EXECUTORS[executor](workers)
+        return _shared[key]
@@ -39,6 +39,17 @@ class BaseFileStore(BaseDataStore):
     def file_exists(self, path):
         raise NotImplementedError
 
+    def delete_files(self, paths):
+        '''
+        Deletes the existing files among paths, returns the number deleted
+        '''
+        deleted = 0
+        for path in paths:
+            if self.file_exists(path):
+                self.delete_file(path)
+                deleted += 1
+        return deleted
+
     def save(self, collection, instance, key=None):
         instance = self.execute_hooks('beforeSave',
             {'instance': instance, 'collection': collection})
@@ -64,32 +75,53 @@ class BaseFileStore(BaseDataStore):
             'path': path,
         }
 
-    def find(self, collection, params):
+    def _existing_paths(self, collection, params):
+        '''
+        Yields the paths named by the params that exist, without opening them
+        '''
         params = self._normalize_params(collection, params)
-        objects = list()
+        paths = list()
         if 'pk' in params:
-            val = params['pk']
-            if self.file_exists(val):
-                objects.append({
-                    'lazy_file': (self.open_file, val),
-                    'path': val,
-                })
+            paths.append(params['pk'])
         if 'pk__in' in params:
-            for val in params['pk__in']:
-                if self.file_exists(val):
-                    objects.append({
-                        'lazy_file': (self.open_file, val),
-                        'path': val,
-                    })
+            paths.extend(params['pk__in'])
+        for path in paths:
+            if self.file_exists(path):
+                yield path
+
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
+        objects = list()
+        for path in self._existing_paths(collection, params):
+            objects.append({
+                'lazy_file': (self.open_file, path),
+                'path': path,
+            })
+        if order_by:
+            objects = self._order_results(objects, order_by)
+        if limit is not None or offset:
+            objects = list(self._apply_window(objects, limit, offset))
         return objects
         raise UnsupportedOperation('Lookups must be by path')
 
+    def count(self, collection, params):
+        return sum(1 for path in self._existing_paths(collection, params))
+
+    def exists(self, collection, params):
+        for path in self._existing_paths(collection, params):
+            return True
+        return False
+
+    def keys(self, collection, params):
+        return list(self._existing_paths(collection, params))
+
     def delete(self, collection, params):
         params = self._normalize_params(collection, params)
+        paths = list()
         if 'pk' in params:
-            self.delete_file(params['pk'])
+            paths.append(params['pk'])
         if 'pk__in' in params:
-            for val in params['pk__in']:
-                self.delete_file(val)
-        return self.execute_hooks('afterDelete',
-            {'collection': collection})
+            paths.extend(params['pk__in'])
+        deleted = self.delete_files(paths)
+        self.execute_hooks('afterDelete', {'collection': collection})
+        return deleted
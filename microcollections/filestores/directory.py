@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import errno
 import os
+from multiprocessing.pool import ThreadPool
 
 from werkzeug.utils import secure_filename
 
@@ -8,9 +10,10 @@ from .core import BaseFileStore
 
 class DirectoryFileStore(BaseFileStore):
 
-    def __init__(self, directory):
+    def __init__(self, directory, delete_workers=8):
         super(DirectoryFileStore, self).__init__()
         self.directory = directory
+        self.delete_workers = delete_workers
 
     def save_file(self, file_obj, path):
         full_path = self.uri(path)
@@ -29,6 +32,25 @@ class DirectoryFileStore(BaseFileStore):
     def delete_file(self, path):
         os.unlink(self.uri(path))
 
+    def _unlink(self, path):
+        try:
+            self.delete_file(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def delete_files(self, paths):
+        paths = list(paths)
+        if len(paths) < 2 or self.delete_workers < 2:
+            return sum(map(self._unlink, paths))
+        pool = ThreadPool(min(self.delete_workers, len(paths)))
+        try:
+            return sum(pool.map(self._unlink, paths))
+        finally:
+            pool.close()
+
     def file_exists(self, path):
         return os.path.exists(self.uri(path))
 
@@ -93,7 +93,8 @@ class ProxyFileStore(BaseFileStore):
             'uri': uri,
         }
 
-    def find(self, collection, params):
+    def find(self, collection, params, order_by=None, limit=None,
+             offset=None, only=None, defer=None, parallel=None):
         params = self._normalize_params(collection, params)
         objects = list()
         if 'pk' in params:
@@ -110,5 +111,9 @@ class ProxyFileStore(BaseFileStore):
                         'lazy_file': (self.open_file, val),
                         'uri': val,
                     })
+        if order_by:
+            objects = self._order_results(objects, order_by)
+        if limit is not None or offset:
+            objects = list(self._apply_window(objects, limit, offset))
         return objects
         raise UnsupportedOperation('Lookups must be by uri')
@@ -4,9 +4,27 @@ import tempfile
 import io
 import os
 import shutil
+import json
+import sqlite3
 
-from microcollections.collections import RawCollection
+import micromodels
+
+from microcollections.collections import RawCollection, Collection
+from microcollections.codecs import Codec, get_codec, iter_json_array
+from microcollections.asynchronous import AsyncCollection, wait_all
+from microcollections.executors import ThreadExecutor, get_executor
+from microcollections.datastores.core import UnsupportedOperation
 from microcollections.datastores.memory import MemoryDataStore
+from microcollections.datastores.sqlite import SQLiteDataStore
+from microcollections.datastores.log import LogDataStore
+from microcollections.datastores import columnar
+from microcollections.datastores.columnar import ColumnarMemoryDataStore
+from microcollections.datastores.sharded import ShardedDataStore, HashRing, \
+    RangePartitioner
+from microcollections.datastores.http import HTTPDataStore, \
+    CircuitBreaker, CircuitOpenError
+from microcollections.datastores.caching import CachingDataStore, \
+    SharedCache
 from microcollections.filestores import FileCollection
 from microcollections.filestores.directory import DirectoryFileStore
 from microcollections.filestores.uri import URICollection
@@ -34,11 +52,1015 @@ class TestMemoryCollection(unittest.TestCase):
         del self.collection['obj1']
         self.assertFalse('obj1' in self.collection)
 
+    def test_get_many(self):
+        self.collection.update({'obj1': {}, 'obj2': {}})
+        self.assertEqual(sorted(self.collection.get_many(['obj1', 'obj3'])),
+                         ['obj1'])
+        self.assertEqual(sorted(self.collection.copy().keys()),
+                         ['obj1', 'obj2'])
+
+    def test_delete_count(self):
+        self.collection.update({'obj1': {}, 'obj2': {}, 'obj3': {}})
+        self.assertEqual(self.collection.find(id__in=['obj1', 'obj4']).delete(),
+                         1)
+        self.assertEqual(self.collection.delete(), 2)
+        self.assertEqual(len(self.collection), 0)
+
+    def test_keys_count_exists(self):
+        self.collection.update({'obj1': {'foo': 'bar'}, 'obj2': {}})
+        self.assertEqual(sorted(self.collection.keys()), ['obj1', 'obj2'])
+        query = self.collection.find(foo='bar')
+        self.assertEqual(list(query.keys()), ['obj1'])
+        self.assertEqual(query.count(), 1)
+        self.assertTrue(query.exists())
+        self.assertFalse(self.collection.exists(foo='baz'))
+
     def test_find(self):
         self.collection['obj1'] = {'foo': 'bar'}
         query = self.collection.find(foo='bar')
         self.assertEqual(len(query), 1)
 
+    def test_save_many(self):
+        messages = list()
+        self.collection.data_store.subsribe('afterSaveMany', messages.append)
+        self.collection.update({'obj1': {'foo': 'bar'}, 'obj2': {}})
+        self.collection.extend([{'id': 'obj3'}])
+        self.assertEqual(len(self.collection), 3)
+        self.assertEqual(self.collection['obj2']['id'], 'obj2')
+        self.assertEqual([len(m['instances']) for m in messages], [2, 1])
+        self.collection.remove_many([self.collection['obj1'],
+                                     self.collection['obj3']])
+        self.assertEqual(list(self.collection.keys()), ['obj2'])
+
+    def test_unit_of_work(self):
+        messages = list()
+        self.collection.data_store.subsribe('afterSaveMany', messages.append)
+        with self.collection.unit_of_work():
+            self.collection.create(id='obj1')
+            self.collection['obj2'] = {}
+            with self.collection.unit_of_work():
+                self.collection.create(id='obj3')
+            self.assertEqual(len(self.collection), 0)
+        self.assertEqual(len(self.collection), 3)
+        self.assertEqual([len(m['instances']) for m in messages], [3])
+        try:
+            with self.collection.unit_of_work():
+                self.collection.create(id='obj4')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse('obj4' in self.collection)
+        #writes are no longer buffered
+        self.collection['obj5'] = {}
+        self.assertTrue('obj5' in self.collection)
+
+    def test_unit_of_work_order(self):
+        with self.collection.unit_of_work():
+            self.collection['obj1'] = {'foo': 'bar'}
+            self.collection.remove({'id': 'obj1'})
+            self.collection['obj2'] = {}
+            self.collection.find(id='obj2').delete()
+            self.collection['obj3'] = {}
+        self.assertEqual(list(self.collection.keys()), ['obj3'])
+
+    def test_unit_of_work_is_per_thread(self):
+        async_collection = AsyncCollection(self.collection, workers=1)
+        try:
+            with self.collection.unit_of_work():
+                async_collection.save({'id': 'obj1'}).get()
+                self.assertTrue('obj1' in self.collection)
+        finally:
+            async_collection.close()
+
+
+class TestMemoryIndexes(unittest.TestCase):
+    def setUp(self):
+        self.data_store = MemoryDataStore()
+        self.collection = RawCollection(self.data_store, name='tickets',
+                                        indexes=['status'])
+        self.collection['t1'] = {'status': 'open'}
+        self.collection['t2'] = {'status': 'closed'}
+        self.collection['t3'] = {'status': 'open', 'tags': ['a']}
+
+    def test_find_by_index(self):
+        self.assertEqual(len(self.collection.find(status='open')), 2)
+        self.assertEqual(len(self.collection.find(status__in=['closed'])), 1)
+        self.assertFalse(self.collection.exists(status='pending'))
+
+    def test_index_maintained(self):
+        self.collection['t1'] = {'status': 'closed'}
+        self.assertEqual(len(self.collection.find(status='open')), 1)
+        self.assertEqual(self.collection.find(status='closed').delete(), 2)
+        self.assertEqual(len(self.collection), 1)
+        index = self.data_store.indexes['tickets']['status']
+        self.assertEqual(index.buckets, {'open': set(['t3'])})
+
+    def test_explain(self):
+        self.collection.indexes = ('status', 'owner')
+        for i in range(10):
+            self.collection['o%s' % i] = {'status': 'open', 'owner': i}
+        query = self.collection.find(status='open', owner__in=[1, 2],
+                                     region='eu')
+        plan = query.explain()
+        steps = [(step.operation, step.param) for step in plan.steps]
+        self.assertEqual(steps[0], ('probe', 'owner__in'))
+        #owner narrows further then status could, so status is filtered
+        self.assertEqual(set(steps[1:]),
+                         set([('filter', 'status'), ('filter', 'region')]))
+        self.assertEqual(len(self.collection.find(status='open',
+                                                  owner__in=[1, 2])), 2)
+        plan = self.collection.find(region='eu').explain()
+        self.assertEqual(plan.steps[0].operation, 'scan')
+
+
+class TestParallelFind(unittest.TestCase):
+    def setUp(self):
+        self.collection = RawCollection(MemoryDataStore())
+        self.collection.extend([{'id': i, 'age': i % 10} for i in range(500)])
+        self.expected = [obj['id'] for obj in self.collection.find(age=3)]
+
+    def test_process_executor(self):
+        query = self.collection.find(age=3).parallel('process', workers=2,
+                                                     chunk_size=50)
+        self.assertEqual([obj['id'] for obj in query], self.expected)
+        self.assertEqual(query.count(), 50)
+
+    def test_unordered_thread_executor(self):
+        executor = ThreadExecutor(4)
+        query = self.collection.find(age=3).parallel(executor, chunk_size=7,
+                                                     ordered=False)
+        self.assertEqual(sorted(obj['id'] for obj in query),
+                         sorted(self.expected))
+        query = query.order_by('-id')[:3]
+        self.assertEqual([obj['id'] for obj in query], [493, 483, 473])
+        executor.close()
+
+    def test_shared_executors(self):
+        self.assertTrue(get_executor('thread', 2) is get_executor('thread', 2))
+        self.assertTrue(get_executor(None) is get_executor('serial'))
+
+
+class TestMemorySortedIndex(unittest.TestCase):
+    def setUp(self):
+        self.data_store = MemoryDataStore()
+        self.collection = RawCollection(self.data_store, name='events',
+                                        sorted_indexes=['created'])
+        for i in range(10):
+            self.collection['e%s' % i] = {'created': i, 'kind': i % 2}
+
+    def test_range_lookups(self):
+        self.assertEqual(len(self.collection.find(created__gte=7)), 3)
+        self.assertEqual(len(self.collection.find(created__lt=3, kind=0)), 2)
+        plan = self.collection.find(created__gt=8).explain()
+        self.assertEqual(plan.steps[0].estimate, 1)
+
+    def test_order_by(self):
+        query = self.collection.find(kind=1).order_by('-created')
+        self.assertEqual([obj['created'] for obj in query], [9, 7, 5, 3, 1])
+        query = self.collection.find(created__lte=2).order_by('created')
+        self.assertEqual([obj['created'] for obj in query], [0, 1, 2])
+
+    def test_order_by_unindexed(self):
+        query = self.collection.find(kind=0).order_by('kind', '-id')
+        self.assertEqual([obj['id'] for obj in query],
+                         ['e8', 'e6', 'e4', 'e2', 'e0'])
+
+    def test_index_maintained(self):
+        self.collection['e0'] = {'created': 20}
+        del self.collection['e1']
+        query = self.collection.all().order_by('-created')
+        self.assertEqual(query.first()['id'], 'e0')
+        self.assertEqual(len(self.collection.find(created__lt=5)), 3)
+
+    def test_save_while_iterating(self):
+        query = self.collection.find(created__lt=5).order_by('created')
+        seen = list()
+        for obj in query:
+            seen.append(obj['id'])
+            self.collection[obj['id']] = {'created': obj['created'] + 1}
+        self.assertEqual(seen, ['e0', 'e1', 'e2', 'e3', 'e4'])
+
+    def test_slicing(self):
+        query = self.collection.all().order_by('created')
+        self.assertEqual([obj['created'] for obj in query[2:5]], [2, 3, 4])
+        self.assertEqual([obj['created'] for obj in query[2:5][1:]], [3, 4])
+        self.assertEqual(query[7]['created'], 7)
+        self.assertEqual(len(query[8:20]), 2)
+        self.assertEqual(len(self.collection.find(kind=0)[1:3]), 2)
+        self.assertRaises(ValueError, lambda: query[-1])
+
+    def test_sliced_keys_exists(self):
+        query = self.collection.all().order_by('created')
+        self.assertRaises(UnsupportedOperation, query[2:4].keys)
+        self.assertFalse(query[0:0].exists())
+        self.assertFalse(query[20:].exists())
+        self.assertTrue(query[2:4].exists())
+
+    def test_save_while_iterating_window(self):
+        for obj in self.collection.all()[:3]:
+            self.collection['new%s' % obj['id']] = {'created': 0}
+        for obj in self.collection.find(kind=0)[:3]:
+            self.collection['odd%s' % obj['id']] = {'kind': 0}
+        self.assertEqual(len(self.collection), 16)
+
+
+class Person(micromodels.Model):
+    id = micromodels.CharField()
+    name = micromodels.CharField()
+    age = micromodels.IntegerField()
+
+
+class TestResultModes(unittest.TestCase):
+    def setUp(self):
+        self.collection = Collection(Person, MemoryDataStore())
+        self.collection.create(id='p1', name='Ann', age='31')
+        self.collection.create(id='p2', name='Bob', age='42')
+
+    def test_values(self):
+        query = self.collection.all().order_by('id')
+        self.assertEqual(list(query.values('pk', 'age')),
+                         [{'pk': 'p1', 'age': 31}, {'pk': 'p2', 'age': 42}])
+        self.assertEqual(list(query.values_list('name', 'age')),
+                         [('Ann', 31), ('Bob', 42)])
+        self.assertEqual(list(query.values_list('name', flat=True)),
+                         ['Ann', 'Bob'])
+        self.assertEqual(query.values_list().first(), ('p1', 'Ann', 31))
+        raw = RawCollection(MemoryDataStore())
+        raw.create(id='r1', zip=1, age=2, name=3)
+        self.assertEqual(raw.all().values_list().first(), ('r1', 2, 3, 1))
+        query.values().first()['age'] = 99
+        self.assertEqual(self.collection['p1'].age, 31)
+
+    def test_only_defer(self):
+        query = self.collection.all().order_by('id')
+        self.assertEqual(list(query.only('name').values()),
+                         [{'id': 'p1', 'name': 'Ann'},
+                          {'id': 'p2', 'name': 'Bob'}])
+        self.assertEqual(query.defer('name', 'id').values().first(),
+                         {'id': 'p1', 'age': 31})
+
+    def test_lazy(self):
+        person = self.collection.find(name='Ann').lazy().first()
+        self.assertEqual(person.age, 31)
+        self.assertEqual(person._instance, None)
+        person.age = 32
+        person.save()
+        self.assertEqual(self.collection['p1'].age, 32)
+
+
+class TestSQLiteDataStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.db')
+        self.collection = self.get_collection()
+        self.collection.extend([
+            {'id': 'obj%s' % i, 'age': i, 'kind': 'ab'[i % 2]}
+            for i in range(10)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_collection(self):
+        return RawCollection(SQLiteDataStore(self.path), name='people',
+                             indexes=['kind'], sorted_indexes=['age'])
+
+    def test_persistence(self):
+        collection = self.get_collection()
+        self.assertEqual(len(collection), 10)
+        self.assertEqual(collection['obj3'], {'id': 'obj3', 'age': 3,
+                                              'kind': 'b'})
+        self.assertFalse('obj99' in collection)
+
+    def test_lookups(self):
+        query = self.collection.find(kind='a', age__gte=4).order_by('-age')
+        self.assertEqual([obj['age'] for obj in query], [8, 6, 4])
+        self.assertEqual([obj['age'] for obj in query[1:]], [6, 4])
+        query = self.collection.find(id__in=['obj1', 'obj2', 'obj42'])
+        self.assertEqual(sorted(query.keys()), ['obj1', 'obj2'])
+        self.assertEqual(query.count(), 2)
+        self.assertFalse(self.collection.exists(age__gt=9))
+        self.assertEqual(self.collection.get_many(['obj1', 'obj42']).keys(),
+                         ['obj1'])
+
+    def test_long_in_lookups(self):
+        self.collection.data_store.batch_size = 2
+        query = self.collection.find(id__in=['obj1', 'obj2', 'obj42'],
+                                     age__in=[1, 2, 3])
+        self.assertEqual(sorted(query.keys()), ['obj1', 'obj2'])
+        self.assertEqual(query.delete(), 2)
+        self.assertEqual(len(self.collection), 8)
+
+    def test_close(self):
+        with SQLiteDataStore(self.path) as store:
+            collection = RawCollection(store, name='people')
+            self.assertEqual(len(collection), 10)
+            #a failed batch is rolled back
+            self.assertRaises(sqlite3.Error, store.save_many, collection,
+                              [{'id': 'obj0', 'age': 99}, {'id': ('obj',)}])
+            self.assertEqual(collection['obj0']['age'], 0)
+            collection['obj0'] = {'age': 1}
+        self.assertEqual(store.connections, [])
+        #reconnects when used again
+        self.assertEqual(collection['obj0'], {'id': 'obj0', 'age': 1})
+        store.close()
+
+    def test_explain(self):
+        plan = self.collection.find(kind='a', age__gte=8).explain()
+        self.assertEqual((plan.steps[0].operation, plan.steps[0].param,
+                          plan.steps[0].estimate), ('probe', 'age__gte', 2))
+        plan = self.collection.find(name='x').explain()
+        self.assertEqual(plan.steps[0].operation, 'scan')
+
+    def test_expression_index(self):
+        store = self.collection.data_store
+        table = store._get_table(self.collection)
+        where, args = store._where({'age__lt': 3})
+        plan = store._get_connection().execute(
+            'EXPLAIN QUERY PLAN SELECT data FROM %s%s' % (table, where),
+            args).fetchall()
+        self.assertTrue('people__age' in plan[0][-1])
+
+    def test_delete(self):
+        self.assertEqual(self.collection.find(kind='a').delete(), 5)
+        self.collection.remove_many([self.collection['obj1']])
+        self.assertEqual(sorted(self.collection.keys()),
+                         ['obj3', 'obj5', 'obj7', 'obj9'])
+
+
+class TestLogDataStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.collection = self.get_collection()
+
+    def tearDown(self):
+        self.collection.data_store.close()
+        shutil.rmtree(self.directory)
+
+    def get_collection(self):
+        store = LogDataStore(self.directory, segment_size=256,
+                             compact_ratio=None)
+        return RawCollection(store, name='events', indexes=['kind'])
+
+    def reopen(self):
+        self.collection.data_store.close()
+        self.collection = self.get_collection()
+        return self.collection
+
+    def get_files(self):
+        return sorted(os.listdir(os.path.join(self.directory, 'events')))
+
+    def test_persistence(self):
+        self.collection.extend([{'id': i, 'kind': 'ab'[i % 2]}
+                                for i in range(20)])
+        self.collection[3] = {'kind': 'c'}
+        self.collection.remove(self.collection[4])
+        self.assertTrue(any(name.endswith('.hint')
+                            for name in self.get_files()))
+        collection = self.reopen()
+        self.assertEqual(len(collection), 19)
+        self.assertEqual(collection[3], {'id': 3, 'kind': 'c'})
+        self.assertFalse(4 in collection)
+        self.assertEqual(sorted(obj['id'] for obj in collection.find(kind='a')),
+                         [0, 2, 6, 8, 10, 12, 14, 16, 18])
+
+    def test_tuple_keys(self):
+        self.collection[(1, 'a')] = {'kind': 'a'}
+        self.collection[(2, 'b')] = {'kind': 'b'}
+        collection = self.reopen()
+        collection[(1, 'a')] = {'kind': 'c'}
+        collection = self.reopen()
+        self.assertEqual(len(collection), 2)
+        self.assertEqual(collection[(1, 'a')]['kind'], 'c')
+        self.assertTrue((2, 'b') in collection)
+
+    def test_torn_write(self):
+        self.collection[1] = {'kind': 'a'}
+        self.collection[2] = {'kind': 'b'}
+        path = os.path.join(self.directory, 'events', self.get_files()[-1])
+        with open(path, 'r+b') as segment:
+            segment.truncate(os.path.getsize(path) - 3)
+        collection = self.reopen()
+        self.assertEqual(list(collection.keys()), [1])
+        collection[3] = {'kind': 'c'}
+        self.assertEqual(sorted(self.reopen().keys()), [1, 3])
+
+    def test_compaction(self):
+        for i in range(10):
+            self.collection.save_many([{'id': pk, 'version': i}
+                                       for pk in range(5)])
+        self.collection.find(id=0).delete()
+        store = self.collection.data_store
+        log = store._get_cstore(self.collection)
+        before = log.total_bytes
+        self.assertTrue(log.compact())
+        self.assertTrue(log.total_bytes < before)
+        self.assertEqual(len([name for name in self.get_files()
+                              if name.endswith('.merged')]), 1)
+        collection = self.reopen()
+        self.assertEqual(sorted(collection.keys()), [1, 2, 3, 4])
+        self.assertEqual(collection[2], {'id': 2, 'version': 9})
+
+    def test_compaction_trigger(self):
+        log = self.collection.data_store._get_cstore(self.collection)
+
+        def needs_compaction():
+            #writes are made without a ratio so no compaction is started
+            log.compact_ratio = 0.5
+            try:
+                return log._needs_compaction()
+            finally:
+                log.compact_ratio = None
+
+        #dead records in the active segment can't be reclaimed yet
+        self.collection[1] = {'version': 1}
+        self.collection[1] = {'version': 2}
+        self.assertFalse(needs_compaction())
+        for i in range(10):
+            self.collection[1] = {'version': i, 'padding': 'x' * 100}
+        self.assertTrue(needs_compaction())
+        log.compact()
+        #a lone merged segment has nothing to be merged with
+        self.assertFalse(needs_compaction())
+        self.collection[1] = {'version': 11}
+        self.assertFalse(needs_compaction())
+
+
+class TestShardedDataStore(unittest.TestCase):
+    def setUp(self):
+        self.shards = [MemoryDataStore() for i in range(3)]
+        self.collection = RawCollection(ShardedDataStore(self.shards),
+                                        sorted_indexes=['age'])
+        self.collection.extend([{'id': i, 'age': i % 7} for i in range(30)])
+
+    def test_routing(self):
+        self.assertEqual(sum(len(shard.collections[None])
+                             for shard in self.shards), 30)
+        self.assertTrue(all(shard.collections[None] for shard in self.shards))
+        self.assertEqual(self.collection[12], {'id': 12, 'age': 5})
+        self.assertEqual(sorted(self.collection.get_many([1, 2, 99]).keys()),
+                         [1, 2])
+        self.assertEqual(len(self.collection), 30)
+        self.assertTrue(self.collection.exists(age=6))
+
+    def test_ordered_window(self):
+        query = self.collection.find(age__gte=5).order_by('-age', 'id')
+        self.assertEqual([obj['id'] for obj in query[2:6]],
+                         [20, 27, 5, 12])
+        query = self.collection.all().order_by('id').only('id')
+        self.assertEqual(list(query[:3]), [{'id': 0}, {'id': 1}, {'id': 2}])
+
+    def test_delete(self):
+        messages = list()
+        self.collection.data_store.subsribe('afterDelete', messages.append)
+        self.assertEqual(self.collection.find(age=0).delete(), 5)
+        self.assertEqual(len(self.collection), 25)
+        self.assertEqual(len(messages), 1)
+
+    def test_lazy_fan_out(self):
+        queried = list()
+        for shard in self.shards:
+            def find(collection, params, shard=shard, find=shard.find,
+                     **options):
+                queried.append(shard)
+                return find(collection, params, **options)
+            shard.find = find
+        self.assertEqual(len(list(self.collection.find(age=1)[:1])), 1)
+        self.assertEqual(len(queried), 1)
+        query = self.collection.all().order_by('-id')
+        self.assertEqual([obj['id'] for obj in query][:3], [29, 28, 27])
+
+    def test_consistent_hashing(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((pk, ring.get_node(pk)) for pk in range(1000))
+        ring.add_node('d')
+        moved = [pk for pk in before if ring.get_node(pk) != before[pk]]
+        self.assertTrue(0 < len(moved) < 400)
+        self.assertTrue(all(ring.get_node(pk) == 'd' for pk in moved))
+
+    def test_range_partitioning(self):
+        store = ShardedDataStore({'low': MemoryDataStore(),
+                                  'high': MemoryDataStore()},
+                                 partitioner=RangePartitioner([10],
+                                                              ['low', 'high']))
+        collection = RawCollection(store)
+        collection.extend([{'id': i} for i in range(15)])
+        self.assertEqual(len(store.shards['low'].collections[None]), 10)
+
+    def test_rebalance(self):
+        store = self.collection.data_store
+        store.shards['shard3'] = MemoryDataStore()
+        store.partitioner.add_node('shard3')
+        moved = store.rebalance(self.collection)
+        self.assertEqual(len(store.shards['shard3'].collections[None]), moved)
+        self.assertEqual(len(self.collection), 30)
+        self.assertEqual(self.collection[12], {'id': 12, 'age': 5})
+
+
+class TestAggregate(unittest.TestCase):
+    data_store_class = MemoryDataStore
+
+    def setUp(self):
+        self.collection = RawCollection(self.data_store_class())
+        self.collection.extend([
+            {'id': i, 'age': i % 5, 'score': i * 0.5, 'kind': 'ab'[i % 2]}
+            for i in range(20)])
+        self.collection.create(id=20, kind='c', score=None)
+
+    def test_aggregate(self):
+        result = self.collection.find(age__gte=3).aggregate(
+            n=('count', 'pk'), total=('sum', 'age'), low=('min', 'score'),
+            high=('max', 'score'), mean=('mean', 'age'))
+        self.assertEqual(result, {'n': 8, 'total': 28, 'low': 1.5,
+                                  'high': 9.5, 'mean': 3.5})
+        self.assertEqual(self.collection.find(kind='x').aggregate(
+            n=('count', 'pk'), mean=('mean', 'age')), {'n': 0, 'mean': None})
+
+    def test_group_by(self):
+        result = self.collection.all().aggregate(group_by='kind',
+                                                 n=('count', 'pk'),
+                                                 scored=('count', 'score'),
+                                                 oldest=('max', 'age'))
+        self.assertEqual(result, [
+            {'kind': 'a', 'n': 10, 'scored': 10, 'oldest': 4},
+            {'kind': 'b', 'n': 10, 'scored': 10, 'oldest': 4},
+            {'kind': 'c', 'n': 1, 'scored': 0, 'oldest': None}])
+        self.assertRaises(UnsupportedOperation,
+                          self.collection.all()[:5].aggregate,
+                          n=('count', 'pk'))
+
+
+class TestColumnarMemoryDataStore(TestAggregate):
+    data_store_class = ColumnarMemoryDataStore
+    #finds and aggregates use the array fallback unless numpy is set
+    numpy = None
+
+    def setUp(self):
+        self.installed_numpy = columnar.numpy
+        columnar.numpy = self.numpy
+        super(TestColumnarMemoryDataStore, self).setUp()
+
+    def tearDown(self):
+        columnar.numpy = self.installed_numpy
+
+    def test_round_trip(self):
+        self.assertEqual(self.collection[3], {'id': 3, 'age': 3, 'score': 1.5,
+                                              'kind': 'b'})
+        self.assertEqual(self.collection[20], {'id': 20, 'kind': 'c',
+                                               'score': None})
+        self.collection[4] = {'age': 'old', 'flag': True}
+        self.assertEqual(self.collection[4], {'id': 4, 'age': 'old',
+                                              'flag': True})
+        self.assertEqual(self.collection[5]['age'], 0)
+
+    def test_find(self):
+        query = self.collection.find(age__lt=2, kind='a').order_by('-id')
+        self.assertEqual([obj['id'] for obj in query], [16, 10, 6, 0])
+        self.assertEqual(list(query.only('kind')[:1]),
+                         [{'id': 16, 'kind': 'a'}])
+        self.assertEqual(query.count(), 4)
+        self.assertEqual(sorted(self.collection.find(id__in=[1, 2, 99])
+                                .keys()), [1, 2])
+
+    def test_remove(self):
+        self.collection.remove(self.collection[0])
+        self.assertEqual(self.collection.find(age=0).delete(), 3)
+        self.assertEqual(len(self.collection), 17)
+        self.assertEqual(self.collection[19]['score'], 9.5)
+        self.assertFalse(self.collection.exists(age=0))
+
+
+@unittest.skipUnless(columnar.numpy, 'numpy is not installed')
+class TestColumnarNumpyDataStore(TestColumnarMemoryDataStore):
+    numpy = columnar.numpy
+
+    def test_vector_paths(self):
+        table = self.data_store_class()
+        collection = RawCollection(table)
+        collection.extend([{'id': i, 'age': i % 3, 'score': i * 1.5}
+                           for i in range(9)])
+        collection[9] = {'age': None}
+        self.assertEqual(sorted(collection.find(age__in=[0, 2]).keys()),
+                         [0, 2, 3, 5, 6, 8])
+        self.assertEqual(len(collection.find(age__gt=0, score__lt=9)), 4)
+        self.assertEqual(collection.all().aggregate(
+            total=('sum', 'age'), n=('count', 'age'), high=('max', 'score')),
+            {'total': 9, 'n': 9, 'high': 12.0})
+
+
+class TestCachingDataStore(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryDataStore()
+        self.data_store = CachingDataStore(self.backend, maxsize=2)
+        self.collection = RawCollection(self.data_store)
+        self.collection.update({'obj1': {'foo': 'bar'}, 'obj2': {}})
+
+    def test_hits(self):
+        self.assertEqual(self.collection['obj1']['foo'], 'bar')
+        self.assertEqual(self.collection['obj1']['foo'], 'bar')
+        self.assertEqual(len(self.collection.find(foo='bar')), 1)
+        self.assertEqual(len(self.collection.find(foo='bar')), 1)
+        stats = self.data_store.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+    def test_invalidation(self):
+        self.assertEqual(len(self.collection.find(foo='bar')), 1)
+        self.assertFalse('obj3' in self.collection)
+        self.collection['obj3'] = {'foo': 'bar'}
+        self.assertTrue('obj3' in self.collection)
+        self.assertEqual(len(self.collection.find(foo='bar')), 2)
+        self.collection['obj1'] = {'foo': 'baz'}
+        self.assertEqual(self.collection['obj1']['foo'], 'baz')
+        self.collection.delete()
+        self.assertEqual(len(self.collection), 0)
+
+    def test_eviction(self):
+        self.collection.update({'obj3': {}})
+        for key in ('obj1', 'obj2', 'obj1', 'obj2', 'obj3', 'obj1'):
+            self.collection[key]
+        stats = self.data_store.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 4))
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(sorted(self.collection.get_many(['obj1', 'obj3'])),
+                         ['obj1', 'obj3'])
+        self.assertEqual(self.data_store.get_stats()['hits'], 4)
+
+    def test_results_are_copies(self):
+        self.collection.find(foo='bar').values()[0]['foo'] = 'baz'
+        self.assertEqual(self.collection.find(foo='bar').values()[0]['foo'],
+                         'bar')
+        self.collection['obj1']['foo'] = 'baz'
+        self.assertEqual(self.collection['obj1']['foo'], 'bar')
+
+    def test_large_finds_are_not_cached(self):
+        store = self.data_store
+        store.max_rows = 1
+        for i in range(2):
+            self.assertEqual(len(list(store.find(self.collection, {}))), 2)
+            self.assertEqual(
+                len(list(store.find(self.collection, {'foo': 'bar'}))), 1)
+        #only the find of a single row was cached
+        self.assertEqual(store.get_stats()['hits'], 1)
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'cache.db')
+        #two workers sharing the data but not the event subscribers
+        worker1 = MemoryDataStore()
+        worker2 = MemoryDataStore()
+        worker2.collections = worker1.collections
+        self.store1 = CachingDataStore(worker1, shared_cache=SharedCache(path),
+                                       sync_interval=0)
+        self.store2 = CachingDataStore(worker2, shared_cache=SharedCache(path),
+                                       sync_interval=0)
+        self.collection1 = RawCollection(self.store1, name='objects')
+        self.collection2 = RawCollection(self.store2, name='objects')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_hits(self):
+        self.collection1['obj1'] = {'foo': 'bar'}
+        self.assertEqual(self.collection1['obj1']['foo'], 'bar')
+        self.assertEqual(self.collection2['obj1']['foo'], 'bar')
+        self.assertEqual(self.store2.get_stats()['shared_hits'], 1)
+
+    def test_invalidation_broadcast(self):
+        self.collection1['obj1'] = {'foo': 'bar'}
+        self.assertEqual(self.collection1['obj1']['foo'], 'bar')
+        self.assertEqual(len(self.collection1.find(foo='bar')), 1)
+        self.collection2['obj1'] = {'foo': 'baz'}
+        self.assertEqual(self.collection1['obj1']['foo'], 'baz')
+        self.assertEqual(len(self.collection1.find(foo='bar')), 0)
+
+    def test_batch_invalidation(self):
+        shared_cache = self.store1.shared_cache
+        before = shared_cache.last_invalidation()
+        self.assertEqual(self.collection2['obj1'], None)
+        self.collection1.extend([{'id': 'obj%s' % i} for i in range(10)])
+        rows = shared_cache.invalidations_since(before)
+        #one row per key and one for the cached queries
+        self.assertEqual(len(rows), 11)
+        self.assertEqual(self.collection2['obj1'], {'id': 'obj1'})
+
+    def test_least_recently_used_eviction(self):
+        shared_cache = SharedCache(os.path.join(self.directory, 'lru.db'),
+                                   maxsize=2)
+        shared_cache.set('objects', 'obj1', 1)
+        shared_cache.set('objects', 'obj2', 2)
+        self.assertEqual(shared_cache.get('objects', 'obj1'), 1)
+        shared_cache.set('objects', 'obj3', 3)
+        shared_cache.purge()
+        self.assertEqual(shared_cache.get('objects', 'obj1'), 1)
+        self.assertEqual(shared_cache.get('objects', 'obj2', None), None)
+
+
+class StubResponse(object):
+    def __init__(self, body, links=None, status_code=200, headers=None):
+        self.content = json.dumps(body)
+        self.links = links or {}
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class StubSession(object):
+    '''
+    Serves an index of objects a page at a time
+    '''
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = list()
+
+    def request(self, method, url, params=None, **kwargs):
+        return getattr(self, method.lower())(url, params)
+
+    def get(self, url, params=None):
+        self.requests.append((url, dict(params or {})))
+        if params is None:
+            pk = int(url.rsplit('/', 1)[1])
+            if pk >= len(self.objects):
+                return StubResponse({}, status_code=404)
+            return StubResponse(self.objects[pk])
+        if 'page' in params:
+            size = params['page_size']
+            start = (params['page'] - 1) * size
+        else:
+            size = params['limit']
+            start = params.get('offset', 0)
+        return StubResponse({'results': self.objects[start:start + size]})
+
+    def head(self, url, params=None):
+        self.requests.append((url, dict(params or {})))
+        if params is None:
+            pk = int(url.rsplit('/', 1)[1])
+            return StubResponse('', status_code=404 if pk >= len(self.objects)
+                                else 200)
+        headers = {'X-Total-Count': str(len(self.objects))}
+        return StubResponse('', headers=headers)
+
+
+class TestHTTPPagination(unittest.TestCase):
+    def setUp(self):
+        self.session = StubSession([{'id': i} for i in range(25)])
+
+    def get_collection(self, **kwargs):
+        return RawCollection(HTTPDataStore('http://example.com/objects',
+                                           session=self.session, **kwargs))
+
+    def test_page_pagination(self):
+        collection = self.get_collection(pagination='page', page_size=10)
+        self.assertEqual([obj['id'] for obj in collection.all()], range(25))
+        self.assertEqual(len(self.session.requests), 3)
+
+    def test_offset_pagination_window(self):
+        collection = self.get_collection(pagination='offset', page_size=10,
+                                         prefetch=True)
+        query = collection.find(kind='a')[12:17]
+        self.assertEqual([obj['id'] for obj in query.iterator()],
+                         range(12, 17))
+        self.assertEqual(self.session.requests[0][1],
+                         {'kind': 'a', 'limit': 5, 'offset': 12})
+
+    def test_get_many(self):
+        collection = self.get_collection()
+        self.assertEqual(collection.get_many([3, 7, 99]),
+                         {3: {'id': 3}, 7: {'id': 7}})
+        self.assertEqual(len(self.session.requests), 3)
+        self.assertEqual(list(collection.find(id__in=[5, 1])),
+                         [{'id': 5}, {'id': 1}])
+
+    def test_count_exists_without_bodies(self):
+        collection = self.get_collection(pagination='page')
+        self.assertEqual(len(collection), 25)
+        self.assertTrue(3 in collection)
+        self.assertFalse(30 in collection)
+        self.assertEqual(len(self.session.requests), 3)
+
+    def test_streamed_listing(self):
+        collection = self.get_collection(stream=True, chunk_size=7)
+        query = collection.find(limit=25)
+        self.assertEqual([obj['id'] for obj in query], range(25))
+        self.assertEqual(self.session.requests[0][1], {'limit': 25})
+
+    def test_streamed_binary_listing(self):
+        keys = list()
+
+        def iterdecode(chunks, key=None):
+            keys.append(key)
+            return iter(json.loads(''.join(chunks))['results'])
+        codec = Codec('stub', json.dumps, json.loads,
+                      content_type='application/x-stub',
+                      iterdecode=iterdecode)
+        collection = self.get_collection(stream=True, codec=codec)
+        self.assertEqual(len(list(collection.find(limit=5))), 5)
+        #only JSON listings are sniffed for the results key
+        self.assertEqual(keys, [None])
+
+    def test_results_are_lazy(self):
+        collection = self.get_collection(pagination='page', page_size=10)
+        self.assertEqual(collection.first()['id'], 0)
+        self.assertEqual(len(self.session.requests), 1)
+
+
+class FlakySession(object):
+    '''
+    Answers with the queued status codes, then with 200
+    '''
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.requests = list()
+        self.responses = list()
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        status_code = self.statuses.pop(0) if self.statuses else 200
+        self.responses.append(StubResponse({'id': 1},
+                                           status_code=status_code))
+        return self.responses[-1]
+
+
+class TestHTTPRetries(unittest.TestCase):
+    def get_collection(self, session, **kwargs):
+        return RawCollection(HTTPDataStore('http://example.com/objects',
+                                           session=session, backoff=0,
+                                           **kwargs))
+
+    def test_retries_idempotent_requests(self):
+        session = FlakySession([503, 502])
+        collection = self.get_collection(session, retries=3, timeout=5)
+        self.assertEqual(collection.get(1), {'id': 1})
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(session.requests[0][2]['timeout'], 5)
+        #the responses of the failed attempts were released
+        self.assertEqual([response.closed for response in session.responses],
+                         [True, True, False])
+
+    def test_does_not_retry_posts(self):
+        session = FlakySession([503])
+        collection = self.get_collection(session, retries=3)
+        collection.create(name='foo')
+        self.assertEqual(len(session.requests), 1)
+
+    def test_compresses_large_bodies(self):
+        session = FlakySession([])
+        collection = self.get_collection(session, compress_min_size=10)
+        collection.create(name='x' * 100)
+        headers = session.requests[0][2]['headers']
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+
+    def test_codec_content_type(self):
+        session = FlakySession([])
+        codec = Codec('stub', json.dumps, json.loads,
+                      content_type='application/x-stub')
+        collection = self.get_collection(session, codec=codec)
+        collection.create(name='foo')
+        collection.get(1)
+        self.assertEqual(session.requests[0][2]['headers'],
+                         {'Content-Type': 'application/x-stub',
+                          'Accept': 'application/x-stub'})
+        self.assertEqual(session.requests[1][2]['headers'],
+                         {'Accept': 'application/x-stub'})
+
+    def test_circuit_breaker(self):
+        session = FlakySession([500, 500, 500])
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        collection = self.get_collection(session, circuit_breaker=breaker)
+        for i in range(2):
+            collection.get(1)
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, collection.get, 1)
+        self.assertEqual(len(session.requests), 2)
+        breaker.reset_timeout = 0
+        self.assertEqual(breaker.state, 'half-open')
+
+
+class VersionedSession(object):
+    '''
+    Serves a single object with an ETag, honouring If-None-Match
+    '''
+    def __init__(self):
+        self.version = 1
+        self.requests = list()
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append((method, dict(headers or {})))
+        if method == 'PUT':
+            self.version += 1
+            return StubResponse({})
+        etag = '"v%s"' % self.version
+        if (headers or {}).get('If-None-Match') == etag:
+            return StubResponse('', status_code=304)
+        return StubResponse({'id': 1, 'version': self.version},
+                            headers={'ETag': etag})
+
+
+class TestHTTPConditionalRequests(unittest.TestCase):
+    def setUp(self):
+        self.session = VersionedSession()
+        self.collection = RawCollection(HTTPDataStore(
+            'http://example.com/objects', session=self.session))
+
+    def test_revalidates_cached_object(self):
+        obj = self.collection.get(1)
+        obj['version'] = 99
+        self.assertEqual(self.collection.get(1), {'id': 1, 'version': 1})
+        self.assertEqual(self.session.requests[1][1],
+                         {'If-None-Match': '"v1"',
+                          'Accept': 'application/json'})
+
+    def test_save_forgets_cached_object(self):
+        self.collection.get(1)
+        self.collection.save({'id': 1})
+        self.assertEqual(self.collection.get(1), {'id': 1, 'version': 2})
+        self.assertEqual(self.session.requests[-1][1],
+                         {'Accept': 'application/json'})
+
+    def test_cache_is_bounded(self):
+        store = HTTPDataStore('http://example.com/objects',
+                              session=self.session, conditional_cache_size=1)
+        collection = RawCollection(store)
+        collection.get(1)
+        collection.get(2)
+        self.assertEqual(len(store.conditional_cache), 1)
+
+
+class TestAsyncCollection(unittest.TestCase):
+    def setUp(self):
+        self.collection = AsyncCollection(RawCollection(MemoryDataStore()),
+                                          workers=4)
+
+    def tearDown(self):
+        self.collection.close()
+
+    def test_calls(self):
+        wait_all([self.collection.save({'id': i, 'even': i % 2 == 0})
+                  for i in range(10)])
+        self.assertEqual(self.collection.count().get(), 10)
+        self.assertEqual([obj['id'] for obj in
+                          wait_all([self.collection.get(3),
+                                    self.collection.get(4)])], [3, 4])
+        self.assertEqual(sorted(self.collection.get_many([3, 4]).get()),
+                         [3, 4])
+        query = self.collection.find(even=True).order_by('id')
+        self.assertEqual([obj['id'] for obj in query], [0, 2, 4, 6, 8])
+        self.assertEqual(len(query.fetch().get()), 5)
+        self.assertTrue(self.collection.exists(id=9).get())
+
+    def test_query_methods(self):
+        wait_all([self.collection.save({'id': i, 'a': i % 2})
+                  for i in range(10)])
+        query = self.collection.find(a=1)
+        self.assertEqual(sorted(query.keys().get()), [1, 3, 5, 7, 9])
+        self.assertEqual(query.aggregate(n=('count', 'pk')).get(), {'n': 5})
+        self.assertEqual([obj['id'] for obj in
+                          query.order_by('id').values().iterator()],
+                         [1, 3, 5, 7, 9])
+
+    def test_concurrent_reads_and_writes(self):
+        results = list()
+        for i in range(200):
+            results.append(self.collection.find(a=1).count())
+            results.append(self.collection.save({'id': i, 'a': i % 2}))
+        wait_all(results)
+        self.assertEqual(self.collection.find(a=1).count().get(), 100)
+
+
+class TestCodecs(unittest.TestCase):
+    def test_default_codec(self):
+        codec = get_codec()
+        self.assertEqual(codec.loads(codec.dumps({'a': [1, 2]})),
+                         {'a': [1, 2]})
+        self.assertTrue(get_codec('json'))
+
+    def test_iter_json_array(self):
+        data = json.dumps([{'id': 1, 'tags': ['a', ']']}, 12345, 'x', None])
+        chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+        self.assertEqual(list(iter_json_array(chunks)),
+                         [{'id': 1, 'tags': ['a', ']']}, 12345, 'x', None])
+        self.assertEqual(list(iter_json_array([' [', ' ] '])), [])
+        self.assertEqual(list(iter_json_array(['[1.', '5, 2e', '3, -1', 'E-',
+                                               '1]'])),
+                         [1.5, 2000.0, -0.1])
+        self.assertRaises(ValueError, list, iter_json_array(['[1, 2']))
+
+    def test_iter_json_array_key(self):
+        data = json.dumps({'count': 2, 'next': {'page': 2},
+                           'results': [{'id': 1}, {'id': 2}]})
+        chunks = [data[i:i + 5] for i in range(0, len(data), 5)]
+        self.assertEqual(list(iter_json_array(chunks, key='results')),
+                         [{'id': 1}, {'id': 2}])
+        self.assertEqual(list(iter_json_array(['{"count": 0}'], 'results')),
+                         [])
+
 
 class TestFileDirectoryCollection(unittest.TestCase):
     def setUp(self):
@@ -68,6 +1090,21 @@ class TestFileDirectoryCollection(unittest.TestCase):
         del self.collection['obj1']
         self.assertFalse('obj1' in self.collection)
 
+    def test_delete_many(self):
+        for name in ('obj1', 'obj2', 'obj3'):
+            self.collection[name] = io.BytesIO('my text file')
+        deleted = self.collection.find(pk__in=['obj1', 'obj3', 'obj4']).delete()
+        self.assertEqual(deleted, 2)
+        self.assertFalse('obj1' in self.collection)
+        self.assertTrue('obj2' in self.collection)
+
+    def test_count_keys(self):
+        for name in ('obj1', 'obj2'):
+            self.collection[name] = io.BytesIO('my text file')
+        query = self.collection.find(pk__in=['obj1', 'obj2', 'obj3'])
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(list(query.keys()), ['obj1', 'obj2'])
+
 
 class TestURIDirectoryCollection(unittest.TestCase):
     def setUp(self):